@@ -4,30 +4,120 @@ Real-time chat with priority queues, batch processing, retry mechanisms, and off
 UPDATED: Added OfflineQueue integration for disconnected users
 """
 
-from flask import Flask, render_template, request, jsonify
-from flask_socketio import SocketIO, emit
+from __future__ import annotations
+
+# Must run before anything else imports socket/threading/time so the whole
+# process (including the queue background threads) runs on green threads
+import eventlet
+eventlet.monkey_patch()
+
+from eventlet import tpool
+
+from flask import Flask, render_template, request
+from flask_socketio import SocketIO, emit, join_room
+import functools
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 import os
+import queue
+import random
 import re
+import sys
+import threading
 import time
 from datetime import datetime
-from typing import Dict, List, Optional, Callable
-from collections import defaultdict
+from typing import TYPE_CHECKING
 from collections import deque
 from models.batch_queue import BatchQueue
-from models.retry_queue import RetryQueue
+from models.retry_queue import RetryQueue, RetryEntry
 from models.circular_queue import CircularQueue
 from models.offline_queue import OfflineQueue  # NEW IMPORT
 from models.user_manager import UserManager  # ADDED IMPORT
-from utils.message_utils import validate_message, validate_username, format_message_for_client, create_system_message
+from utils.message_utils import validate_message
+from utils import json_utils
+from utils.keyword_matcher import KeywordMatcher
+
+# Only needed for annotations, which are not evaluated at runtime
+if TYPE_CHECKING:
+    from typing import Dict, List, Optional, Tuple
 
 # Load environment variables
 load_dotenv()
 
+
+def create_logger():
+    """
+    Create the chat logger
+    
+    The model modules log to children of it (chat.batch_queue,
+    chat.offline_queue, ...), so their records share its handler. Records are
+    only enqueued on the calling thread; a background QueueListener drains
+    them to stdout. Under eventlet.monkey_patch() that listener is a green
+    thread on the same hub as the socket handlers, so a stdout write that
+    blocks still pauses the hub while it runs.
+    Set LOG_LEVEL=DEBUG to enable per-message logging; unknown levels fall
+    back to INFO.
+    """
+    log_queue = queue.Queue(-1)
+    
+    level_name = os.getenv("LOG_LEVEL", "INFO").upper()
+    level = logging.getLevelName(level_name)  # int for known names, a string otherwise
+    
+    chat_logger = logging.getLogger("chat")
+    chat_logger.setLevel(level if isinstance(level, int) else logging.INFO)
+    chat_logger.addHandler(QueueHandler(log_queue))
+    chat_logger.propagate = False
+    
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    
+    if not isinstance(level, int):
+        chat_logger.warning(f"Unknown LOG_LEVEL '{level_name}', using INFO")
+    
+    return chat_logger, listener
+
+
+logger, log_listener = create_logger()
+
+# Display name for each priority level (index 0 unused)
+_PRIO_NAMES = (None, "URGENT", "HIGH", "NORMAL", "LOW")
+
+# Coarse wall clock for per-message timestamps, refreshed every CLOCK_TICK_INTERVAL
+# seconds by a background thread so the hot path only reads two globals
+CLOCK_TICK_INTERVAL = 0.1
+_NOW_TS = time.time()
+_NOW_ISO = datetime.fromtimestamp(_NOW_TS).isoformat()
+
+
+def _clock_ticker():
+    """Background loop that refreshes the cached _NOW_TS/_NOW_ISO clock"""
+    global _NOW_TS, _NOW_ISO
+    
+    while True:
+        now = time.time()
+        _NOW_ISO = datetime.fromtimestamp(now).isoformat()
+        _NOW_TS = now
+        time.sleep(CLOCK_TICK_INTERVAL)
+
+
+threading.Thread(target=_clock_ticker, daemon=True).start()
+
+
 class SpamDetector:
     """Spam detection for chat messages"""
     
+    # Log wording for each named group of the structural pattern
+    STRUCTURAL_REASONS = {
+        "repeated_chars": "Repeated characters",
+        "repeated_words": "Repeated words",
+        "url": "URL found",
+        "caps": "Too many capitals"
+    }
+    
     def __init__(self):
         self.spam_keywords = [
             "buy now", "free money", "visit this site",
@@ -39,52 +129,58 @@ class SpamDetector:
             "winner", "claim now", "exclusive deal"
         ]
         
-        self.repeated_char_pattern = re.compile(r"(.)\1{4,}")
-        self.url_pattern = re.compile(r"(https?://\S+|www\.\S+)", re.IGNORECASE)
-        self.repeated_word_pattern = re.compile(r"\b(\w+)\s+\1\s+\1", re.IGNORECASE)
-        self.caps_pattern = re.compile(r"[A-Z]{10,}")
+        # Whole-word keyword scan, a single Aho-Corasick pass when pyahocorasick is installed
+        self.keyword_matcher = KeywordMatcher({"spam": self.spam_keywords})
+        
+        # Structural spam checks fused into one pass over the original text. The
+        # case-insensitive parts are scoped with (?i:...) so the caps check stays
+        # case-sensitive; lastgroup names the check that fired.
+        self.structural_pattern = re.compile(
+            r"(?P<repeated_chars>(?i:(.)\2{4,}))"
+            r"|(?P<repeated_words>(?i:\b(\w+)\s+\4\s+\4))"
+            r"|(?P<url>(?i:https?://\S+|www\.\S+))"
+            r"|(?P<caps>[A-Z]{10,})"
+        )
+        self.symbol_pattern = re.compile(r"[^a-z0-9\s]")
     
     def normalize(self, text: str) -> str:
         """Remove punctuation/symbols and lowercase the text."""
-        return re.sub(r"[^a-z0-9\s]", "", text.lower())
+        return self.normalize_from_lower(text.lower())
     
-    def is_spam(self, text: str) -> bool:
-        """Check if message is spam"""
+    def normalize_from_lower(self, text_lower: str) -> str:
+        """Remove punctuation/symbols from already-lowercased text."""
+        return self.symbol_pattern.sub("", text_lower)
+    
+    def is_spam(self, text: str, text_lower: Optional[str] = None, text_clean: Optional[str] = None) -> bool:
+        """
+        Check if message is spam
+        
+        text_lower/text_clean may be passed in when the caller has already
+        computed them, so the message is only lowercased and normalized once.
+        """
         if not text:
             return False
         
-        text_lower = text.lower()
-        text_clean = self.normalize(text)
-        
-        # Keyword-based detection
-        for keyword in self.spam_keywords:
-            if keyword in text_clean:
-                print(f"SPAM DETECTED: Keyword '{keyword}' in message: '{text[:50]}...'")
-                return True
-        
-        # Repeated character spam
-        if self.repeated_char_pattern.search(text_lower):
-            print(f"SPAM DETECTED: Repeated characters in: '{text[:50]}...'")
-            return True
+        if text_lower is None:
+            text_lower = text.lower()
+        if text_clean is None:
+            text_clean = self.normalize_from_lower(text_lower)
         
-        # Repeated word spam
-        if self.repeated_word_pattern.search(text_lower):
-            print(f"SPAM DETECTED: Repeated words in: '{text[:50]}...'")
+        # Message length check (O(1), so it goes first)
+        if len(text) > 300:
+            logger.info(f"SPAM DETECTED: Message too long ({len(text)} chars): '{text[:50]}...'")
             return True
         
-        # URL detection
-        if self.url_pattern.search(text):
-            print(f"SPAM DETECTED: URL found in: '{text[:50]}...'")
+        # Repeated characters/words, URLs and too many capitals
+        structural_match = self.structural_pattern.search(text)
+        if structural_match:
+            logger.info(f"SPAM DETECTED: {self.STRUCTURAL_REASONS[structural_match.lastgroup]} in: '{text[:50]}...'")
             return True
         
-        # Message length check
-        if len(text) > 300:
-            print(f"SPAM DETECTED: Message too long ({len(text)} chars): '{text[:50]}...'")
-            return True
-        
-        # Too many capitals
-        if self.caps_pattern.search(text):
-            print(f"SPAM DETECTED: Too many capitals in: '{text[:50]}...'")
+        # Keyword-based detection
+        keyword_match = self.keyword_matcher.search(text_clean)
+        if keyword_match:
+            logger.info(f"SPAM DETECTED: Keyword '{keyword_match['spam']}' in message: '{text[:50]}...'")
             return True
         
         return False
@@ -95,31 +191,37 @@ class DisplayMessageQueue:
     Message queue that only displays messages after batch processing
     """
     
+    # Client-facing category key for each priority level (index 0 unused)
+    CATEGORY_KEYS = (None, "urgent", "high", "normal", "low")
+    
     def __init__(self, max_messages_per_category=50):
         self.max_messages_per_category = max_messages_per_category
         
-        # Separate queues for each priority level (what users see)
-        self.display_queues = {
-            1: deque(maxlen=max_messages_per_category),  # URGENT
-            2: deque(maxlen=max_messages_per_category),  # HIGH  
-            3: deque(maxlen=max_messages_per_category),  # NORMAL
-            4: deque(maxlen=max_messages_per_category)   # LOW/SPAM
-        }
-        
-        # Priority names mapping
-        self.priority_names = {
-            1: "URGENT",
-            2: "HIGH", 
-            3: "NORMAL",
-            4: "LOW"
-        }
+        # Separate queues for each priority level (what users see), indexed by priority
+        # 1: URGENT, 2: HIGH, 3: NORMAL, 4: LOW/SPAM
+        self.display_queues = [deque(maxlen=max_messages_per_category) for _ in range(5)]
         
         # Message counter for unique IDs
         self.message_counter = 0
+        
+        # Incremented once per displayed batch so clients can apply batches as ordered deltas
+        self.batch_seq = 0
+        
+        # Per-priority list snapshots, invalidated only for the categories a batch touched,
+        # and the organized dict built from them; both rebuilt lazily
+        self._category_snapshots = [None] * 5
+        self._organized_cache = None
     
     def add_batch_messages(self, messages: List[Dict]):
         """Add messages from completed batch to display queues"""
-        added_count = 0
+        added_count = len(messages)
+        display_queues = self.display_queues
+        category_snapshots = self._category_snapshots
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        
+        # Stable partition of the batch by priority, then one C-level extend per
+        # category instead of an append (and snapshot invalidation) per message
+        by_priority = ([], [], [], [], [])
         
         for message_data in messages:
             priority = message_data.get("priority", 3)
@@ -129,25 +231,45 @@ class DisplayMessageQueue:
                 self.message_counter += 1
                 message_data["id"] = self.message_counter
             
-            # Add to appropriate display queue
-            self.display_queues[priority].append(message_data)
-            added_count += 1
+            by_priority[priority].append(message_data)
             
-            print(f"Added to DISPLAY: {self.priority_names[priority]} - '{message_data['text'][:30]}...'")
+            if debug_enabled:
+                logger.debug(f"Added to DISPLAY: {_PRIO_NAMES[priority]} - '{message_data['text'][:30]}...'")
+        
+        # Add to appropriate display queues
+        for priority in range(1, 5):
+            if by_priority[priority]:
+                display_queues[priority].extend(by_priority[priority])
+                category_snapshots[priority] = None
+        
+        if added_count:
+            self.batch_seq += 1
+            self._organized_cache = None
         
-        print(f"BATCH DISPLAYED: {added_count} messages now visible to users")
+        logger.info(f"BATCH DISPLAYED: {added_count} messages now visible to users")
         return added_count
     
     def get_all_messages_organized(self):
-        """Get all messages organized by priority (what users see)"""
-        organized_messages = {
-            "urgent": list(self.display_queues[1]),
-            "high": list(self.display_queues[2]), 
-            "normal": list(self.display_queues[3]),
-            "low": list(self.display_queues[4])
-        }
+        """
+        Get all messages organized by priority (what users see)
+        
+        The returned dict is a shared snapshot; callers must not mutate it.
+        Its "seq" is the batch_seq the snapshot reflects.
+        """
+        if self._organized_cache is None:
+            display_queues = self.display_queues
+            category_snapshots = self._category_snapshots
+            organized_messages = {}
+            
+            for priority in range(1, 5):
+                if category_snapshots[priority] is None:
+                    category_snapshots[priority] = list(display_queues[priority])
+                organized_messages[self.CATEGORY_KEYS[priority]] = category_snapshots[priority]
+            
+            organized_messages["seq"] = self.batch_seq
+            self._organized_cache = organized_messages
         
-        return organized_messages
+        return self._organized_cache
     
     def get_queue_stats(self):
         """Get statistics about display queues"""
@@ -156,18 +278,41 @@ class DisplayMessageQueue:
             "high_count": len(self.display_queues[2]),
             "normal_count": len(self.display_queues[3]),
             "low_count": len(self.display_queues[4]),
-            "total_messages": sum(len(queue) for queue in self.display_queues.values())
+            "total_messages": sum(len(queue) for queue in self.display_queues)
         }
     
     def clear_all(self):
         """Clear all display queues"""
-        for queue in self.display_queues.values():
+        for queue in self.display_queues:
             queue.clear()
         self.message_counter = 0
+        self._category_snapshots = [None] * 5
+        self._organized_cache = None
+
+
+# Priority keywords, built once at import time so urgent and high are found in
+# one scan of the lowercased text
+_PRIORITY_MATCHER = KeywordMatcher({
+    "urgent": [
+        "urgent", "emergency", "asap", "immediately", "critical", "help", "issue",
+        "problem", "error", "bug", "down", "broken", "failed", "crash", "alert"
+    ],
+    "high": [
+        "important", "priority", "deadline", "meeting", "review", "approval",
+        "decision", "update", "status", "progress"
+    ]
+})
 
+# Every byte except ASCII A-Z, stripped with bytes.translate to count capitals in C
+_NON_UPPER_BYTES = bytes(b for b in range(256) if not 65 <= b <= 90)
 
-def detect_message_priority(message: str, manual_priority: int = None) -> int:
-    """Auto-detect message priority based on content analysis"""
+
+def detect_message_priority(message: str, manual_priority: int = None, text_lower: Optional[str] = None) -> int:
+    """
+    Auto-detect message priority based on content analysis
+    
+    text_lower may be passed in when the caller has already lowercased the message.
+    """
     # If manual priority is set and valid, use it
     if manual_priority is not None and manual_priority in [1, 2, 3, 4]:
         return manual_priority
@@ -175,44 +320,54 @@ def detect_message_priority(message: str, manual_priority: int = None) -> int:
     if not message:
         return 3  # NORMAL
     
-    message_lower = message.lower()
-    
-    # URGENT priority keywords
-    urgent_keywords = [
-        'urgent', 'emergency', 'asap', 'immediately', 'critical',
-        'help', 'issue', 'problem', 'error', 'bug', 'down',
-        'broken', 'failed', 'crash', 'alert'
-    ]
-    
-    # HIGH priority keywords  
-    high_keywords = [
-        'important', 'priority', 'deadline', 'meeting', 'review',
-        'approval', 'decision', 'update', 'status', 'progress'
-    ]
-    
     # Check for ALL CAPS (indicates urgency/emphasis)
-    caps_ratio = sum(1 for c in message if c.isupper()) / len(message) if message else 0
-    if caps_ratio > 0.7 and len(message) > 10:
-        return 1  # URGENT
+    message_length = len(message)
+    if message_length > 10:
+        upper_count = len(message.encode('ascii', 'ignore').translate(None, _NON_UPPER_BYTES))
+        if upper_count / message_length > 0.7:
+            return 1  # URGENT
     
     # Check for @mentions (indicates direct communication)
     if '@' in message:
         return 2  # HIGH
     
+    if text_lower is None:
+        text_lower = message.lower()
+    
+    keyword_hits = _PRIORITY_MATCHER.search(text_lower)
+    
     # Check for urgent keywords
-    for keyword in urgent_keywords:
-        if keyword in message_lower:
-            return 1  # URGENT
+    if "urgent" in keyword_hits:
+        return 1  # URGENT
     
     # Check for high priority keywords
-    for keyword in high_keywords:
-        if keyword in message_lower:
-            return 2  # HIGH
+    if "high" in keyword_hits:
+        return 2  # HIGH
     
     # Default priority
     return 3  # NORMAL
 
 
+def classify_message(message: str, manual_priority: int = None) -> Tuple[int, bool]:
+    """
+    Classify a message for priority and spam in a single call
+    
+    The message is lowercased and normalized once and shared by both detectors.
+    Spam is checked first since it always forces LOW priority, which makes the
+    priority scan unnecessary for spam messages.
+    
+    Returns:
+        Tuple of (priority, is_spam)
+    """
+    text_lower = message.lower()
+    text_clean = spam_detector.normalize_from_lower(text_lower)
+    
+    if spam_detector.is_spam(message, text_lower=text_lower, text_clean=text_clean):
+        return 4, True  # LOW
+    
+    return detect_message_priority(message, manual_priority, text_lower=text_lower), False
+
+
 def create_app():
     """Application factory pattern"""
     app = Flask(__name__)
@@ -231,7 +386,8 @@ def create_socketio(app):
         cors_allowed_origins="*",
         logger=False,
         engineio_logger=False,
-        async_mode='threading'
+        json=json_utils,  # orjson-backed packet encoding when available
+        async_mode='eventlet'
     )
 
 
@@ -242,7 +398,9 @@ socketio = create_socketio(app)
 # Initialize components
 spam_detector = SpamDetector()
 display_queue = DisplayMessageQueue()
-user_manager = UserManager()  # NEW: Initialize user manager
+# Password hashing is CPU-bound for hundreds of milliseconds; run it on
+# eventlet's native thread pool so a login doesn't stall every other client
+user_manager = UserManager(hash_runner=tpool.execute)  # NEW: Initialize user manager
 
 
 # NEW: Offline message delivery callback
@@ -253,94 +411,110 @@ def offline_delivery_callback(username: str, delivered_messages: List[Dict]):
     Args:
         username: Username that received messages
         delivered_messages: List of messages that were delivered
+    
+    Returns:
+        True if the messages were emitted; False makes the offline queue
+        keep them for another attempt
     """
     try:
-        if username in user_manager.users and user_manager.users[username].socket_id:
-            # Send offline messages to the specific user
-            socketio.emit('offline_messages_delivered', {
-                'message_count': len(delivered_messages),
-                'messages': delivered_messages,
-                'delivery_timestamp': time.time()
-            }, room=user_manager.users[username].socket_id)
-            
-            print(f"Sent {len(delivered_messages)} offline messages to {username}")
+        user = user_manager.users.get(username)
+        socket_id = user.socket_id if user else None
+        if not socket_id:
+            logger.warning(f"No socket for {username}, keeping {len(delivered_messages)} offline messages queued")
+            return False
+        
+        # Send offline messages to the specific user
+        socketio.emit('offline_messages_delivered', {
+            'message_count': len(delivered_messages),
+            'messages': delivered_messages,
+            'delivery_timestamp': _NOW_TS
+        }, room=socket_id)
+        
+        logger.info(f"Sent {len(delivered_messages)} offline messages to {username}")
+        return True
         
     except Exception as e:
-        print(f"Offline delivery callback error: {e}")
+        logger.error(f"Offline delivery callback error: {e}")
+        return False
 
 
 # Batch transmission callback
 def batch_transmission_callback(batch_data: Dict):
     """Handle batch transmission via SocketIO"""
     try:
-        print(f"TRANSMITTING BATCH: {batch_data['batch_id']} ({batch_data['batch_size']} messages)")
+        logger.info(f"TRANSMITTING BATCH: {batch_data['batch_id']} ({batch_data['batch_size']} messages)")
         
         # Add batch messages to display queue (users can now see them)
         display_queue.add_batch_messages(batch_data['messages'])
         
-        # Emit the updated organization (this is when users see messages)
-        organized_messages = display_queue.get_all_messages_organized()
-        socketio.emit("message_organization", organized_messages)
-        
-        # Emit batch update notification
-        socketio.emit('batch_update', {
-            'batch_id': batch_data['batch_id'],
-            'batch_size': batch_data['batch_size'],
-            'send_reason': batch_data['send_reason'],
-            'efficiency_stats': {
-                'wait_time': batch_data['wait_time'],
-                'efficiency_score': min(100, (batch_data['batch_size'] / batch_queue.max_batch_size) * 100)
+        # Emit only the new messages (this is when users see them) together with the batch
+        # summary as a single event to logged-in clients; they append it to the snapshot
+        # they got at login, using seq to detect gaps
+        socketio.emit("batch_tick", {
+            'seq': display_queue.batch_seq,
+            'messages': batch_data['messages'],
+            'batch': {
+                'batch_id': batch_data['batch_id'],
+                'batch_size': batch_data['batch_size'],
+                'send_reason': batch_data['send_reason'],
+                'efficiency_stats': {
+                    'wait_time': batch_data['wait_time'],
+                    'efficiency_score': min(100, (batch_data['batch_size'] / batch_queue.max_batch_size) * 100)
+                }
             }
-        })
+        }, room=LOGGED_IN_ROOM)
         
-        print(f"Batch transmitted and displayed to users")
+        logger.info("Batch transmitted and displayed to users")
         
     except Exception as e:
-        print(f"Batch transmission error: {e}")
+        logger.error(f"Batch transmission error: {e}")
 
 
 # Retry success callback
-def retry_success_callback(retry_entry: Dict, total_retry_time: float):
+def retry_success_callback(retry_entry: RetryEntry, total_retry_time: float):
     """Handle successful message retry"""
     try:
-        print(f"MESSAGE RETRY SUCCESS: {retry_entry['retry_id']}")
+        logger.info(f"MESSAGE RETRY SUCCESS: {retry_entry.label}")
         
-        # Add the successfully retried message back to batch queue
-        message = retry_entry['message']
-        message['retry_success'] = True
-        message['retry_attempts'] = retry_entry['retry_count']
-        message['retry_time'] = total_retry_time
+        # Add the successfully retried message back to batch queue; the
+        # entry's message is read-only, so the retry fields go on a new dict
+        message = {
+            **retry_entry.message,
+            'retry_success': True,
+            'retry_attempts': retry_entry.retry_count,
+            'retry_time': total_retry_time
+        }
         
         # Add to batch queue (will be displayed when batch is sent)
         batch_queue.add_message(message)
         
         socketio.emit('retry_success', {
             'message_id': message.get('id'),
-            'retry_attempts': retry_entry['retry_count'],
+            'retry_attempts': retry_entry.retry_count,
             'total_time': total_retry_time
         })
         
     except Exception as e:
-        print(f"Retry success callback error: {e}")
+        logger.error(f"Retry success callback error: {e}")
 
 
 # Retry failure callback  
-def retry_failure_callback(retry_entry: Dict, failure_reason: str):
+def retry_failure_callback(retry_entry: RetryEntry, failure_reason: str):
     """Handle permanent message retry failure"""
     try:
-        print(f"MESSAGE RETRY FAILED PERMANENTLY: {retry_entry['retry_id']}")
+        logger.warning(f"MESSAGE RETRY FAILED PERMANENTLY: {retry_entry.label}")
         
         socketio.emit('retry_failure', {
-            'message_id': retry_entry['message'].get('id'),
-            'retry_attempts': retry_entry['retry_count'],
+            'message_id': retry_entry.message.get('id'),
+            'retry_attempts': retry_entry.retry_count,
             'failure_reason': failure_reason,
-            'original_text': retry_entry['message'].get('text', '')[:50]
+            'original_text': retry_entry.message.get('text', '')[:50]
         })
         
-        print(f"Message moved to dead letter queue: '{retry_entry['message'].get('text', '')[:50]}...'")
+        logger.warning(f"Message moved to dead letter queue: '{retry_entry.message.get('text', '')[:50]}...'")
         
     except Exception as e:
-        print(f"Retry failure callback error: {e}")
+        logger.error(f"Retry failure callback error: {e}")
 
 
 # Initialize all queues
@@ -376,27 +550,40 @@ user_manager.set_offline_queue(offline_queue)
 # Get access code from environment
 ACCESS_CODE = os.getenv("CHAT_ACCESS_CODE", "supersecret123")
 
+# SocketIO room joined by every authenticated connection
+LOGGED_IN_ROOM = "logged_in"
+
+# Simulated delivery failures feed the retry queue for testing; off unless SIMULATE_FAILURES=1
+SIMULATE_FAILURES = os.getenv("SIMULATE_FAILURES", "0") == "1"
+
+# Simulated delivery success rate per priority (index 0 unused): URGENT, HIGH, NORMAL, LOW/SPAM
+_SIMULATED_SUCCESS_RATES = (0.0, 0.9, 0.85, 0.8, 0.7)
+
 
 def simulate_message_delivery(message: Dict) -> bool:
     """Simulate message delivery for testing retry queue"""
-    import random
-    
     # Simulate different failure rates based on priority
-    if message.get('priority') == 1:  # URGENT
-        success_rate = 0.9
-    elif message.get('priority') == 2:  # HIGH
-        success_rate = 0.85
-    elif message.get('priority') == 3:  # NORMAL
-        success_rate = 0.8
-    else:  # LOW/SPAM
-        success_rate = 0.7
+    return random.random() < _SIMULATED_SUCCESS_RATES[message.get('priority', 4)]
+
+
+def with_user(handler):
+    """
+    Resolve the calling socket's username once and pass it as the handler's first
+    argument; events from sockets that have not logged in are ignored
+    """
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        username = user_manager.get_user_by_socket(request.sid)
+        if not username:
+            return None
+        return handler(username, *args, **kwargs)
     
-    return random.random() < success_rate
+    return wrapper
 
 
 @socketio.on("connect")
 def handle_connect():
-    print(f"Client connected: {request.sid}")
+    logger.info(f"Client connected: {request.sid}")
     
     # Send current message organization to new client
     organized_messages = display_queue.get_all_messages_organized()
@@ -410,7 +597,7 @@ def handle_connect():
 
 @socketio.on("disconnect")
 def handle_disconnect():
-    print(f"Client disconnected: {request.sid}")
+    logger.info(f"Client disconnected: {request.sid}")
     
     # Handle user going offline through user manager
     username = user_manager.set_user_offline(request.sid)
@@ -431,7 +618,7 @@ def handle_login(data):
         
         if secret != ACCESS_CODE:
             emit("login_error", "Invalid secret key")
-            print(f"Failed login attempt - User: {username}, Key: {secret}")
+            logger.warning(f"Failed login attempt - User: {username}, Key: {secret}")
             return
         
         # NEW: Register or login user through UserManager
@@ -450,12 +637,13 @@ def handle_login(data):
         
         # Set user online
         user_manager.set_user_online(username, request.sid)
+        join_room(LOGGED_IN_ROOM)
         
         # NEW: Check for offline messages and deliver them
-        delivery_summary = offline_queue.handle_user_online(username, user_manager)
+        delivery_summary = offline_queue.handle_user_online(username, user_manager.is_user_online)
         
         emit("login_success", {"username": username})
-        print(f"User '{username}' logged in successfully")
+        logger.info(f"User '{username}' logged in successfully")
         
         # NEW: Notify about offline messages if any were delivered
         if delivery_summary and delivery_summary['messages_delivered'] > 0:
@@ -474,7 +662,7 @@ def handle_login(data):
         emit("offline_stats", offline_queue.get_queue_status())  # NEW
         
     except Exception as e:
-        print(f"Login error: {e}")
+        logger.error(f"Login error: {e}")
         emit("login_error", "Login failed")
 
 
@@ -485,7 +673,7 @@ def handle_message(data):
         # Get username from UserManager
         username = user_manager.get_user_by_socket(request.sid)
         if not username:
-            print(f"Message from unauthorized user: {request.sid}")
+            logger.warning(f"Message from unauthorized user: {request.sid}")
             return
         
         message = data.get("message", "").strip()
@@ -494,7 +682,8 @@ def handle_message(data):
         if not message:
             return
         
-        print(f"NEW MESSAGE from '{username}': '{message}'")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"NEW MESSAGE from '{username}': '{message}'")
         
         # Validate message
         validation_result = validate_message(message)
@@ -512,79 +701,74 @@ def handle_message(data):
         except (ValueError, TypeError):
             manual_priority = None
         
-        # Auto-detect priority
-        priority = detect_message_priority(message, manual_priority)
-        
-        # Check for spam
-        is_spam = spam_detector.is_spam(message)
+        # Auto-detect priority and check for spam (spam forces LOW priority)
+        priority, is_spam = classify_message(message, manual_priority)
         if is_spam:
-            priority = 4
             alert_message = "SPAM DETECTED"
-            print(f"SPAM MESSAGE from '{username}': '{message}'")
+            logger.info(f"SPAM MESSAGE from '{username}': '{message}'")
         else:
             alert_message = None
         
-        priority_names = {
-            1: "URGENT",
-            2: "HIGH", 
-            3: "NORMAL",
-            4: "LOW"
-        }
+        priority_name = _PRIO_NAMES[priority]
         
         msg_data = {
             "user": username,
             "text": message,
             "priority": priority,
-            "priority_name": priority_names.get(priority, "NORMAL"),
+            "priority_name": priority_name,
             "is_spam": is_spam,
             "alert_message": alert_message,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": _NOW_ISO,
             "session_id": request.sid
         }
         
         # Update user activity
         user_manager.update_user_activity(username)
         
+        # msg_data must not be mutated after this point: it is shared by
+        # reference. Only the batch queue (which stamps batch fields and display
+        # IDs onto its message) gets a private copy; the offline queue keeps it by
+        # reference and the retry entry holds a read-only view of this same object.
+        
         # Add to circular history for record keeping
-        circular_queue.enqueue(msg_data.copy())
+        circular_queue.enqueue(msg_data)
         
         # Add to batch queue for online users
         batch_queue.add_message(msg_data.copy())
         
         # NEW: Store message for offline users (if this is a broadcast or group message)
-        offline_users = []
-        for user_obj in user_manager.users.values():
-            if not user_obj.is_online:
-                offline_users.append(user_obj.username)
+        # Snapshot the maintained set so concurrent logins/logouts can't mutate it mid-iteration
+        offline_users = tuple(user_manager.offline_usernames) if user_manager.offline_usernames else ()
         
         if offline_users:
-            offline_queue.store_message_for_multiple_users(offline_users, msg_data.copy())
-            print(f"Stored message for {len(offline_users)} offline users")
+            offline_queue.store_message_for_multiple_users(offline_users, msg_data)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Stored message for {len(offline_users)} offline users")
         
         # Simulate message delivery attempt (for retry queue testing)
-        delivery_success = simulate_message_delivery(msg_data)
-        
-        if not delivery_success:
+        if SIMULATE_FAILURES and not simulate_message_delivery(msg_data):
             # Add to retry queue if delivery failed
             retry_queue.add_failed_message(
-                msg_data.copy(), 
+                msg_data,
                 error_reason="simulated_network_failure",
-                original_timestamp=time.time()
+                original_timestamp=_NOW_TS
             )
         
         # Send confirmation to sender only
+        pending_count = batch_queue.pending_count
         emit("message_queued", {
             "status": "Message queued for batch processing",
-            "priority": priority_names.get(priority),
-            "batch_queue_size": len(batch_queue.get_pending_messages()),
-            "estimated_wait": f"Waiting for {5 - len(batch_queue.current_batch)} more messages or {batch_queue.max_wait_time}s timeout",
+            "priority": priority_name,
+            "batch_queue_size": pending_count,
+            "estimated_wait": f"Waiting for {batch_queue.min_batch_size - batch_queue.current_batch_size} more messages or {batch_queue.max_wait_time}s timeout",
             "offline_users_notified": len(offline_users)  # NEW
         })
         
-        print(f"Message QUEUED: Priority={priority_names.get(priority)}, Queue={len(batch_queue.get_pending_messages())}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Message QUEUED: Priority={priority_name}, Queue={pending_count}")
         
     except Exception as e:
-        print(f"Message handling error: {e}")
+        logger.error(f"Message handling error: {e}")
 
 
 # NEW: Socket events for offline queue
@@ -596,30 +780,27 @@ def handle_request_offline_stats():
 
 
 @socketio.on("request_my_offline_count")
-def handle_request_my_offline_count():
+@with_user
+def handle_request_my_offline_count(username):
     """Get offline message count for current user"""
-    username = user_manager.get_user_by_socket(request.sid)
-    if username:
-        count = offline_queue.get_offline_message_count(username)
-        emit("my_offline_count", {"count": count, "username": username})
+    count = offline_queue.get_offline_message_count(username)
+    emit("my_offline_count", {"count": count, "username": username})
 
 
 @socketio.on("preview_my_offline_messages")
-def handle_preview_my_offline_messages():
+@with_user
+def handle_preview_my_offline_messages(username):
     """Preview offline messages for current user"""
-    username = user_manager.get_user_by_socket(request.sid)
-    if username:
-        preview = offline_queue.peek_user_messages(username, 5)
-        emit("offline_messages_preview", {"messages": preview, "username": username})
+    preview = offline_queue.peek_user_messages(username, 5)
+    emit("offline_messages_preview", {"messages": preview, "username": username})
 
 
 @socketio.on("clear_my_offline_messages")
-def handle_clear_my_offline_messages():
+@with_user
+def handle_clear_my_offline_messages(username):
     """Clear offline messages for current user"""
-    username = user_manager.get_user_by_socket(request.sid)
-    if username:
-        cleared_count = offline_queue.clear_user_messages(username)
-        emit("offline_messages_cleared", {"cleared_count": cleared_count, "username": username})
+    cleared_count = offline_queue.clear_user_messages(username)
+    emit("offline_messages_cleared", {"cleared_count": cleared_count, "username": username})
 
 
 # Existing socket events
@@ -645,27 +826,28 @@ def handle_request_retry_stats():
 
 
 @socketio.on("force_batch_send")
-def handle_force_batch_send():
+@with_user
+def handle_force_batch_send(username):
     """Force send current batch (admin function)"""
-    username = user_manager.get_user_by_socket(request.sid)
-    if username:
-        batch_data = batch_queue.force_send_batch()
-        if batch_data:
-            emit("batch_forced", {
-                'batch_id': batch_data['batch_id'],
-                'batch_size': batch_data['batch_size']
-            }, broadcast=True)
-        else:
-            emit("batch_force_result", {"success": False, "reason": "No messages in batch"})
+    batch_data = batch_queue.force_send_batch()
+    if batch_data:
+        # Clients already got the batch (send_reason "forced") in the callback's
+        # single batch_tick emit, so only the requester gets a confirmation
+        emit("batch_force_result", {
+            "success": True,
+            'batch_id': batch_data['batch_id'],
+            'batch_size': batch_data['batch_size']
+        })
+    else:
+        emit("batch_force_result", {"success": False, "reason": "No messages in batch"})
 
 
 @socketio.on("force_retry_all")
-def handle_force_retry_all():
+@with_user
+def handle_force_retry_all(username):
     """Force retry all waiting messages (admin function)"""
-    username = user_manager.get_user_by_socket(request.sid)
-    if username:
-        moved_count = retry_queue.force_retry_all()
-        emit("retry_forced", {"messages_moved": moved_count}, broadcast=True)
+    moved_count = retry_queue.force_retry_all()
+    emit("retry_forced", {"messages_moved": moved_count}, broadcast=True)
 
 
 # Routes
@@ -682,7 +864,7 @@ def health_check():
     batch_stats = batch_queue.get_queue_status()
     retry_stats = retry_queue.get_queue_status()
     offline_stats = offline_queue.get_queue_status()  # NEW
-    user_stats = user_manager.get_user_stats()  # NEW
+    user_stats = user_manager.get_user_stats(snapshot={'queue_status': offline_stats})  # NEW
     
     return {
         'status': 'healthy',
@@ -723,7 +905,7 @@ def get_stats():
     batch_stats = batch_queue.get_queue_status()
     retry_stats = retry_queue.get_queue_status()
     offline_stats = offline_queue.get_queue_status()  # NEW
-    user_stats = user_manager.get_user_stats()  # NEW
+    user_stats = user_manager.get_user_stats(snapshot={'queue_status': offline_stats})  # NEW
     
     return {
         'user_management': user_stats,  # NEW
@@ -816,7 +998,7 @@ def get_batch_queue():
     return {
         "pending_messages": pending,
         "count": len(pending),
-        "current_batch_size": len(batch_queue.current_batch),
+        "current_batch_size": batch_queue.current_batch_size,
         "queue_size": len(batch_queue.message_queue)
     }
 
@@ -824,15 +1006,19 @@ def get_batch_queue():
 @app.route('/export-logs')
 def export_logs():
     """Export comprehensive system logs"""
-    return {
+    export = {
         'export_timestamp': datetime.now().isoformat(),
         'batch_log': batch_queue.export_batch_log(),
         'retry_log': retry_queue.export_retry_log(),
         'offline_log': offline_queue.export_offline_log(),  # NEW
         'display_stats': display_queue.get_queue_stats(),
         'user_stats': user_manager.get_user_stats(),  # NEW
-        'connected_users_count': len(user_manager.online_users)  # NEW
+        'connected_users_count': len(user_manager.socket_to_user)  # NEW
     }
+    
+    # The offline log alone can hold every pending message, so serialize with
+    # orjson (when installed) instead of Flask's stdlib-based jsonify
+    return app.response_class(json_utils.dumps(export), mimetype='application/json')
 
 
 @app.route('/clear-display')
@@ -902,70 +1088,73 @@ def get_all_users_summary():
     return {"users": user_manager.get_all_users_summary()}
 
 
+# Startup banner, printed with a single write in main()
+STARTUP_BANNER_LINES = (
+    "=" * 60,
+    "🚀 Enhanced Priority Queue Chat System with OFFLINE QUEUE Starting...",
+    "=" * 60,
+    "📍 Main Interface: http://localhost:5000",
+    "📊 Health Check:  http://localhost:5000/health",
+    "📈 Statistics:    http://localhost:5000/stats",
+    "💬 Messages API:  http://localhost:5000/messages",
+    "📦 Batch Stats:   http://localhost:5000/batch-stats",
+    "📦 Batch Queue:   http://localhost:5000/batch-queue",
+    "💾 Offline Stats: http://localhost:5000/offline-stats",
+    "👥 Offline Users: http://localhost:5000/offline-users",
+    "=" * 60,
+    "🆕 NEW USER MANAGEMENT ENDPOINTS:",
+    "👤 User Activity: http://localhost:5000/user-activity-report",
+    "📡 Broadcast Info: http://localhost:5000/users-for-broadcast",
+    "👥 All Users: http://localhost:5000/all-users-summary",
+    "=" * 60,
+    "🎯 Priority Queue Features:",
+    "  🔴 URGENT Messages   (Top Priority)",
+    "  🟡 HIGH Messages     (Second Priority)",
+    "  🟢 NORMAL Messages   (Third Priority)",
+    "  ⚫ LOW/SPAM Messages (Bottom Priority)",
+    "=" * 60,
+    "🆕 NEW OFFLINE QUEUE FEATURES:",
+    "  💾 Stores messages for disconnected users",
+    "  📬 Auto-delivers when users reconnect",
+    "  ⏰ Messages expire after 24 hours",
+    "  🧹 Automatic cleanup every 5 minutes",
+    "  👥 Supports up to 100 messages per user",
+    "  📊 Real-time offline message monitoring",
+    "=" * 60,
+    "🛠️ Queue System:",
+    "  📦 Messages ONLY appear after batch processing",
+    "  ⏳ Users wait for 5 messages OR 2 seconds",
+    "  🔄 Failed messages go to retry queue",
+    "  💾 Messages for offline users stored separately",
+    "  ✅ All queue operations are thread-safe",
+    "=" * 60,
+    "🆕 Offline Queue Testing URLs:",
+    "  💾 /offline-stats - View offline queue statistics",
+    "  👥 /offline-users - See users with pending messages",
+    "  📨 /offline-messages/<username> - Preview user's offline messages",
+    "  🧹 /clear-offline-messages/<username> - Clear user's messages",
+    "  🧹 /force-offline-cleanup - Force expire old messages",
+    "=" * 60,
+    "✨ Auto-Detection:",
+    "  ✅ Keywords: 'urgent', 'emergency', 'help', 'error', etc.",
+    "  ✅ ALL CAPS messages (>70% capitals)",
+    "  ✅ @mentions for HIGH priority",
+    "  ✅ Spam detection forces LOW priority",
+    "  ✅ Manual priority override available",
+    "=" * 60
+)
+
+
 def main():
     """Main application entry point"""
-    print("=" * 60)
-    print("🚀 Enhanced Priority Queue Chat System with OFFLINE QUEUE Starting...")
-    print("=" * 60)
-    print("📍 Main Interface: http://localhost:5000")
-    print("📊 Health Check:  http://localhost:5000/health")
-    print("📈 Statistics:    http://localhost:5000/stats")
-    print("💬 Messages API:  http://localhost:5000/messages")
-    print("📦 Batch Stats:   http://localhost:5000/batch-stats")
-    print("📦 Batch Queue:   http://localhost:5000/batch-queue")
-    print("💾 Offline Stats: http://localhost:5000/offline-stats")
-    print("👥 Offline Users: http://localhost:5000/offline-users")
-    print("=" * 60)
-    print("🆕 NEW USER MANAGEMENT ENDPOINTS:")
-    print("👤 User Activity: http://localhost:5000/user-activity-report")
-    print("📡 Broadcast Info: http://localhost:5000/users-for-broadcast") 
-    print("👥 All Users: http://localhost:5000/all-users-summary")
-    print("=" * 60)
-    print("🎯 Priority Queue Features:")
-    print("  🔴 URGENT Messages   (Top Priority)")
-    print("  🟡 HIGH Messages     (Second Priority)")
-    print("  🟢 NORMAL Messages   (Third Priority)")
-    print("  ⚫ LOW/SPAM Messages (Bottom Priority)")
-    print("=" * 60)
-    print("🆕 NEW OFFLINE QUEUE FEATURES:")
-    print("  💾 Stores messages for disconnected users")
-    print("  📬 Auto-delivers when users reconnect")
-    print("  ⏰ Messages expire after 24 hours")
-    print("  🧹 Automatic cleanup every 5 minutes")
-    print("  👥 Supports up to 100 messages per user")
-    print("  📊 Real-time offline message monitoring")
-    print("=" * 60)
-    print("🛠️ Queue System:")
-    print("  📦 Messages ONLY appear after batch processing")
-    print("  ⏳ Users wait for 5 messages OR 2 seconds")
-    print("  🔄 Failed messages go to retry queue")
-    print("  💾 Messages for offline users stored separately")
-    print("  ✅ All queue operations are thread-safe")
-    print("=" * 60)
-    print("🆕 Offline Queue Testing URLs:")
-    print("  💾 /offline-stats - View offline queue statistics")
-    print("  👥 /offline-users - See users with pending messages")
-    print("  📨 /offline-messages/<username> - Preview user's offline messages")
-    print("  🧹 /clear-offline-messages/<username> - Clear user's messages")
-    print("  🧹 /force-offline-cleanup - Force expire old messages")
-    print("=" * 60)
-    print("✨ Auto-Detection:")
-    print("  ✅ Keywords: 'urgent', 'emergency', 'help', 'error', etc.")
-    print("  ✅ ALL CAPS messages (>70% capitals)")
-    print("  ✅ @mentions for HIGH priority")
-    print("  ✅ Spam detection forces LOW priority")
-    print("  ✅ Manual priority override available")
-    print("=" * 60)
-    print(f"🔑 Access Code: {ACCESS_CODE}")
-    print("=" * 60)
+    print("\n".join(STARTUP_BANNER_LINES + (f"🔑 Access Code: {ACCESS_CODE}", "=" * 60)))
     
     try:
         socketio.run(
             app,
             debug=True,
             port=5000,
-            host='127.0.0.1',
-            allow_unsafe_werkzeug=True
+            host='127.0.0.1'
         )
     except KeyboardInterrupt:
         print("\n👋 Priority Chat system shutting down...")
@@ -973,12 +1162,14 @@ def main():
         batch_queue.stop()
         retry_queue.stop()
         offline_queue.stop()  # NEW
+        log_listener.stop()
     except Exception as e:
         print(f"🚨 Fatal error: {str(e)}")
         # Clean shutdown on error
         batch_queue.stop()
         retry_queue.stop()
         offline_queue.stop()  # NEW
+        log_listener.stop()
 
 
 if __name__ == '__main__':
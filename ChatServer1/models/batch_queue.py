@@ -3,6 +3,8 @@ Batch Queue Implementation
 Groups messages for efficient network transmission
 """
 
+import itertools
+import logging
 import time
 import threading
 from collections import deque
@@ -10,6 +12,30 @@ from typing import List, Dict, Optional, Callable
 from datetime import datetime
 import json
 
+logger = logging.getLogger("chat.batch_queue")
+
+
+class QueuedMessage:
+    """
+    A message waiting in the batch queue, with the batch fields it will be stamped with
+    
+    Uses __slots__ so each queued entry is a fixed-layout object with no per-instance dict.
+    """
+    __slots__ = ('batch_timestamp', 'batch_id', 'message')
+    
+    def __init__(self, batch_timestamp: float, batch_id: int, message: Dict):
+        self.batch_timestamp = batch_timestamp
+        self.batch_id = batch_id
+        self.message = message
+    
+    def to_dict(self) -> Dict:
+        """Stamp the batch fields onto the message dict and return it"""
+        message = self.message
+        if 'batch_timestamp' not in message:
+            message['batch_timestamp'] = self.batch_timestamp
+        message['batch_id'] = self.batch_id
+        return message
+
 
 class BatchQueue:
     """
@@ -35,32 +61,53 @@ class BatchQueue:
         self.max_wait_time = max_wait_time
         self.callback = callback
         
-        # Main message queue (FIFO)
+        # Main message queue (FIFO) of QueuedMessage entries; the message dict
+        # itself is only stamped when its batch is sent.
+        # Producers append without taking the lock:
+        # deque.append/popleft are atomic, so many producers can feed the
+        # single processor thread safely (MPSC)
         self.message_queue = deque()
         
-        # Current batch being assembled
+        # Per-message sequence used as the message's batch_id
+        self._message_seq = itertools.count(1)
+        
+        # Current batch being assembled. When a batch opens the list is allocated
+        # once at max_batch_size and filled by index; only the first
+        # _batch_len slots hold messages
         self.current_batch = []
-        self.batch_start_time = None
+        self._batch_len = 0
+        self.batch_start_time = None  # time.monotonic(), only used for elapsed time
+        self._deadline = None  # Monotonic time the open batch is sent even if not full
         
         # Statistics
         self.stats = {
             'total_messages_processed': 0,
             'total_batches_sent': 0,
+            'total_messages_in_batches': 0,
             'average_batch_size': 0.0,
             'total_wait_time': 0.0,
             'average_wait_time': 0.0,
             'efficiency_score': 0.0
         }
         
-        # Thread control
+        # Copy of stats shared by status readers, only re-copied after stats change
+        self._stats_snapshot = None
+        self._stats_dirty = True
+        
+        # Thread control. The lock guards current_batch and stats; it is never
+        # taken on the add_message path
         self.running = True
         self.lock = threading.Lock()
         
+        # Set by producers to wake the processor; it has its own internal lock,
+        # so signalling never contends with batch assembly
+        self._wakeup = threading.Event()
+        
         # Start batch processor thread
         self.processor_thread = threading.Thread(target=self._batch_processor, daemon=True)
         self.processor_thread.start()
         
-        print(f"✅ BatchQueue initialized: min={min_batch_size}, max={max_batch_size}, wait={max_wait_time}s")
+        logger.info(f"✅ BatchQueue initialized: min={min_batch_size}, max={max_batch_size}, wait={max_wait_time}s")
     
     def add_message(self, message: Dict) -> bool:
         """
@@ -73,93 +120,149 @@ class BatchQueue:
             bool: True if message was added successfully
         """
         try:
-            with self.lock:
-                # Add timestamp if not present
-                if 'batch_timestamp' not in message:
-                    message['batch_timestamp'] = time.time()
-                
-                # Add unique batch ID
-                message['batch_id'] = f"batch_{int(time.time() * 1000)}_{len(self.message_queue)}"
-                
-                # Add to queue
-                self.message_queue.append(message)
-                self.stats['total_messages_processed'] += 1
-                
-                print(f"📥 Added message to batch queue: '{message.get('text', '')[:30]}...' (Queue size: {len(self.message_queue)})")
-                
-                return True
-                
+            # Queue the message with its timestamp and unique batch ID (a plain
+            # integer sequence number); stats are published by the processor thread
+            self.message_queue.append(QueuedMessage(time.time(), next(self._message_seq), message))
+            
+            # Event.set() takes the event's internal lock, so skip it when the
+            # processor is already due to wake. Safe because the append comes
+            # first: the processor clears the event before it drains
+            if not self._wakeup.is_set():
+                self._wakeup.set()
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"📥 Added message to batch queue: '{message.get('text', '')[:30]}...' (Queue size: {len(self.message_queue)})")
+            
+            return True
+            
         except Exception as e:
-            print(f"❌ Error adding message to batch queue: {e}")
+            logger.error(f"❌ Error adding message to batch queue: {e}")
             return False
     
     def _batch_processor(self):
         """
         Background thread that processes messages into batches
         """
-        print("🔄 Batch processor thread started")
+        logger.debug("🔄 Batch processor thread started")
         
         while self.running:
             try:
+                # Clear before draining so a message appended after the drain
+                # still wakes the wait below
+                self._wakeup.clear()
+                
                 with self.lock:
-                    # Check if we have messages to process
-                    if not self.message_queue:
-                        time.sleep(0.1)
-                        continue
-                    
-                    # Initialize batch if empty
-                    if not self.current_batch:
-                        self.batch_start_time = time.time()
-                    
-                    # Move messages from queue to current batch
-                    while self.message_queue and len(self.current_batch) < self.max_batch_size:
-                        message = self.message_queue.popleft()
-                        self.current_batch.append(message)
+                    if self.message_queue:
+                        # Initialize batch if empty
+                        if not self._batch_len:
+                            self.batch_start_time = time.monotonic()
+                            self.current_batch = [None] * self.max_batch_size
+                        elif len(self.current_batch) < self.max_batch_size:
+                            # max_batch_size was raised while this batch was open
+                            self.current_batch.extend([None] * (self.max_batch_size - len(self.current_batch)))
+                        
+                        # Move messages from queue to current batch in one C-level pass:
+                        # starmap calls popleft() moved_count times with no Python loop.
+                        # Only this thread pops, so the queue can't shrink underneath us
+                        batch_len = self._batch_len
+                        moved_count = max(0, min(self.max_batch_size - batch_len, len(self.message_queue)))
+                        self.current_batch[batch_len:batch_len + moved_count] = itertools.starmap(
+                            self.message_queue.popleft, itertools.repeat((), moved_count)
+                        )
+                        self._batch_len = batch_len + moved_count
+                        self.stats['total_messages_processed'] += moved_count
+                        self._stats_dirty = True
+                        
+                        # The deadline only moves when the batch opens or reaches min size
+                        if not batch_len or batch_len < self.min_batch_size <= self._batch_len:
+                            self._deadline = self._batch_deadline()
                     
                     # Check if batch should be sent
                     should_send = False
                     send_reason = ""
+                    wait_timeout = None  # Idle: sleep until a message arrives
                     
-                    if len(self.current_batch) >= self.max_batch_size:
+                    if self._batch_len >= self.max_batch_size:
                         should_send = True
                         send_reason = "max_size_reached"
-                    elif len(self.current_batch) >= self.min_batch_size:
-                        time_elapsed = time.time() - self.batch_start_time
-                        if time_elapsed >= self.max_wait_time:
-                            should_send = True
-                            send_reason = "max_wait_time_reached"
-                    elif self.current_batch and self.batch_start_time:
-                        time_elapsed = time.time() - self.batch_start_time
-                        if time_elapsed >= self.max_wait_time * 2:  # Extended wait for small batches
+                    elif self._batch_len:
+                        wait_timeout = self._deadline - time.monotonic()
+                        if wait_timeout <= 0:
                             should_send = True
-                            send_reason = "extended_wait_timeout"
+                            if self._batch_len >= self.min_batch_size:
+                                send_reason = "max_wait_time_reached"
+                            else:
+                                send_reason = "extended_wait_timeout"
                 
-                if should_send and self.current_batch:
+                if should_send and self._batch_len:
+                    # Loop straight back: during a burst the next batch may already be queued
                     self._send_batch(send_reason)
+                    continue
                 
-                time.sleep(0.1)  # Small delay to prevent excessive CPU usage
+                # Sleep until the open batch's deadline or the next message
+                self._wakeup.wait(wait_timeout)
                 
             except Exception as e:
-                print(f"❌ Batch processor error: {e}")
-                time.sleep(0.5)
+                logger.error(f"❌ Batch processor error: {e}")
+                # Back off after an error, but let stop() or a new message cut it short
+                self._wakeup.wait(0.5)
+    
+    def _batch_deadline(self) -> float:
+        """
+        Compute when the open batch must be sent even if it is not full
+        
+        Returns:
+            float: Deadline on the time.monotonic() clock
+        """
+        if self._batch_len >= self.min_batch_size:
+            return self.batch_start_time + self.max_wait_time
+        return self.batch_start_time + self.max_wait_time * 2  # Extended wait for small batches
+    
+    @staticmethod
+    def _stamp_batch(outgoing: List) -> None:
+        """
+        Replace queued entries with their message dicts, in place
+        
+        Attaches batch_timestamp (unless the message already has one) and
+        batch_id on the way, so the dict writes happen once per message on
+        the sending thread instead of on every producer.
+        
+        Args:
+            outgoing: Batch list of QueuedMessage entries
+        """
+        for index, entry in enumerate(outgoing):
+            outgoing[index] = entry.to_dict()
     
     def _send_batch(self, reason: str):
         """
         Send current batch and reset for next batch
         
+        The batch list is handed to the callback as-is rather than copied, so
+        the callback owns it and must not expect it to stay in the queue.
+        
         Args:
             reason: Reason why batch is being sent
         """
-        if not self.current_batch:
+        if not self._batch_len:
             return
         
+        # Take ownership of the batch (trimming the unused slots in place) and
+        # reset for the next one
+        outgoing = self.current_batch
+        del outgoing[self._batch_len:]
+        batch_start_time = self.batch_start_time
+        self.current_batch = []
+        self._batch_len = 0
+        self.batch_start_time = None
+        self._stamp_batch(outgoing)
+        
         batch_data = {
             'batch_id': f"batch_{int(time.time() * 1000)}",
-            'messages': self.current_batch.copy(),
-            'batch_size': len(self.current_batch),
+            'messages': outgoing,
+            'batch_size': len(outgoing),
             'send_reason': reason,
             'timestamp': time.time(),
-            'wait_time': time.time() - self.batch_start_time if self.batch_start_time else 0
+            'wait_time': time.monotonic() - batch_start_time if batch_start_time else 0
         }
         
         # Update statistics
@@ -167,25 +270,23 @@ class BatchQueue:
         self.stats['total_wait_time'] += batch_data['wait_time']
         self.stats['average_wait_time'] = self.stats['total_wait_time'] / self.stats['total_batches_sent']
         
-        # Calculate average batch size
-        total_messages_in_batches = self.stats['total_batches_sent'] * batch_data['batch_size']
-        self.stats['average_batch_size'] = total_messages_in_batches / self.stats['total_batches_sent']
+        # Calculate average batch size from a running total of sent messages
+        self.stats['total_messages_in_batches'] += batch_data['batch_size']
+        self.stats['average_batch_size'] = self.stats['total_messages_in_batches'] / self.stats['total_batches_sent']
         
         # Calculate efficiency score (higher is better)
         self.stats['efficiency_score'] = min(100, (batch_data['batch_size'] / self.max_batch_size) * 100)
+        self._stats_dirty = True
         
-        print(f"📦 BATCH SENT: {batch_data['batch_size']} messages, reason: {reason}, wait: {batch_data['wait_time']:.2f}s")
+        logger.debug("📦 BATCH SENT: %d messages, reason: %s, wait: %.2fs",
+                     batch_data['batch_size'], reason, batch_data['wait_time'])
         
         # Call callback if provided
         if self.callback:
             try:
                 self.callback(batch_data)
             except Exception as e:
-                print(f"❌ Batch callback error: {e}")
-        
-        # Reset current batch
-        self.current_batch = []
-        self.batch_start_time = None
+                logger.error(f"❌ Batch callback error: {e}")
     
     def force_send_batch(self) -> Optional[Dict]:
         """
@@ -195,48 +296,78 @@ class BatchQueue:
             Dict: Batch data that was sent, or None if no messages
         """
         with self.lock:
-            if self.current_batch:
+            if self._batch_len:
+                # Take ownership of the batch instead of copying it
+                outgoing = self.current_batch
+                del outgoing[self._batch_len:]
+                batch_start_time = self.batch_start_time
+                self.current_batch = []
+                self._batch_len = 0
+                self.batch_start_time = None
+                self._stamp_batch(outgoing)
+                
                 batch_data = {
                     'batch_id': f"forced_batch_{int(time.time() * 1000)}",
-                    'messages': self.current_batch.copy(),
-                    'batch_size': len(self.current_batch),
+                    'messages': outgoing,
+                    'batch_size': len(outgoing),
                     'send_reason': 'forced',
                     'timestamp': time.time(),
-                    'wait_time': time.time() - self.batch_start_time if self.batch_start_time else 0
+                    'wait_time': time.monotonic() - batch_start_time if batch_start_time else 0
                 }
                 
-                print(f"🚀 FORCED BATCH SEND: {batch_data['batch_size']} messages")
+                logger.info(f"🚀 FORCED BATCH SEND: {batch_data['batch_size']} messages")
                 
                 if self.callback:
                     self.callback(batch_data)
                 
-                self.current_batch = []
-                self.batch_start_time = None
-                
                 return batch_data
         
         return None
     
+    def _get_stats_snapshot(self) -> Dict:
+        """
+        Get a copy of the statistics, re-copied only when they have changed
+        
+        The snapshot is shared between callers, who must not mutate it.
+        
+        Returns:
+            Dict: Statistics snapshot
+        """
+        if self._stats_dirty:
+            # Clear the flag before copying so an update racing with the copy
+            # marks the snapshot dirty again
+            self._stats_dirty = False
+            self._stats_snapshot = self.stats.copy()
+        return self._stats_snapshot
+    
     def get_queue_status(self) -> Dict:
         """
         Get current queue status and statistics
         
+        The lock is only held to snapshot the queue/batch sizes. Statistics are
+        only written by the processor thread and are copied without the lock,
+        so they may be one batch stale; the copy is cached until they change.
+        
         Returns:
             Dict: Current status information
         """
         with self.lock:
-            return {
-                'queue_size': len(self.message_queue),
-                'current_batch_size': len(self.current_batch),
-                'batch_wait_time': time.time() - self.batch_start_time if self.batch_start_time else 0,
-                'is_processing': self.running,
-                'configuration': {
-                    'min_batch_size': self.min_batch_size,
-                    'max_batch_size': self.max_batch_size,
-                    'max_wait_time': self.max_wait_time
-                },
-                'statistics': self.stats.copy()
-            }
+            queue_size = len(self.message_queue)
+            current_batch_size = self._batch_len
+            batch_start_time = self.batch_start_time
+        
+        return {
+            'queue_size': queue_size,
+            'current_batch_size': current_batch_size,
+            'batch_wait_time': time.monotonic() - batch_start_time if batch_start_time else 0,
+            'is_processing': self.running,
+            'configuration': {
+                'min_batch_size': self.min_batch_size,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_time': self.max_wait_time
+            },
+            'statistics': self._get_stats_snapshot()
+        }
     
     def update_config(self, 
                      min_batch_size: Optional[int] = None,
@@ -257,24 +388,38 @@ class BatchQueue:
                 self.max_batch_size = max(self.min_batch_size, max_batch_size)
             if max_wait_time is not None:
                 self.max_wait_time = max(0.1, max_wait_time)
+            
+            if self._batch_len:
+                self._deadline = self._batch_deadline()
+        
+        # Re-evaluate the open batch's deadline against the new configuration
+        self._wakeup.set()
         
-        print(f"⚙️ Batch config updated: min={self.min_batch_size}, max={self.max_batch_size}, wait={self.max_wait_time}s")
+        logger.info(f"⚙️ Batch config updated: min={self.min_batch_size}, max={self.max_batch_size}, wait={self.max_wait_time}s")
     
     def clear_queue(self):
         """Clear all messages from queue and current batch"""
         with self.lock:
-            cleared_count = len(self.message_queue) + len(self.current_batch)
+            queue_size = len(self.message_queue)
+            batch_size = self._batch_len
             self.message_queue.clear()
+            # Detach the batch so its entries are released after the lock is dropped
+            dropped_batch = self.current_batch
             self.current_batch = []
+            self._batch_len = 0
             self.batch_start_time = None
         
-        print(f"🗑️ Cleared {cleared_count} messages from batch queue")
+        del dropped_batch
+        cleared_count = queue_size + batch_size
+        
+        logger.info(f"🗑️ Cleared {cleared_count} messages from batch queue")
         
         return cleared_count
     
     def stop(self):
         """Stop the batch processor"""
         self.running = False
+        self._wakeup.set()
         
         # Send any remaining messages
         self.force_send_batch()
@@ -283,7 +428,17 @@ class BatchQueue:
         if self.processor_thread.is_alive():
             self.processor_thread.join(timeout=2.0)
         
-        print("⏹️ Batch queue stopped")
+        logger.info("⏹️ Batch queue stopped")
+    
+    @property
+    def pending_count(self) -> int:
+        """Number of pending messages (in queue + current batch) without copying them"""
+        return len(self.message_queue) + self._batch_len
+    
+    @property
+    def current_batch_size(self) -> int:
+        """Number of messages in the batch currently being assembled"""
+        return self._batch_len
     
     def get_pending_messages(self) -> List[Dict]:
         """
@@ -293,7 +448,8 @@ class BatchQueue:
             List[Dict]: All pending messages
         """
         with self.lock:
-            return list(self.message_queue) + self.current_batch
+            return ([entry.message for entry in self.message_queue]
+                    + [entry.message for entry in self.current_batch[:self._batch_len]])
     
     def export_batch_log(self) -> Dict:
         """
@@ -311,10 +467,10 @@ class BatchQueue:
             },
             'current_state': {
                 'queue_size': len(self.message_queue),
-                'current_batch_size': len(self.current_batch),
+                'current_batch_size': self._batch_len,
                 'is_running': self.running
             },
-            'statistics': self.stats.copy()
+            'statistics': self._get_stats_snapshot()
         }
 
 
@@ -331,12 +487,15 @@ def batch_transmission_callback(batch_data: Dict):
     print(f"   ⏱️ Wait time: {batch_data['wait_time']:.2f}s")
     print(f"   🎯 Reason: {batch_data['send_reason']}")
     
-    # Here you would typically send the batch to clients via SocketIO
-    # For example: socketio.emit('batch_messages', batch_data, broadcast=True)
+    # Here you would typically send the batch to clients via SocketIO, as one
+    # emit carrying every message rather than one emit per message
+    # For example: socketio.emit('batch_messages', {'messages': batch_data['messages'], 'meta': {...}})
 
 
 # Example usage and testing
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    
     # Create batch queue with callback
     batch_queue = BatchQueue(
         min_batch_size=3,
@@ -3,13 +3,64 @@ Offline Queue Implementation
 Stores messages for disconnected users and delivers them when they reconnect
 """
 
+import heapq
+import itertools
+import logging
 import time
 import threading
-from collections import deque, defaultdict
-from typing import Dict, List, Optional, Callable, Set
+from collections import deque
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Callable, Set
 from datetime import datetime
 import json
 
+logger = logging.getLogger("chat.offline_queue")
+
+# Number of per-user lock shards (a power of two so a mask picks the shard)
+LOCK_SHARDS = 64
+
+
+class OfflineMessage:
+    """
+    A message stored for an offline user, with its delivery tracking fields
+    
+    Uses __slots__ instead of a per-message dict to keep stored messages small.
+    """
+    __slots__ = ('message_id', 'target_username', 'stored_timestamp', 'expiry_timestamp',
+                 'delivery_attempts', 'is_delivered', 'original_message',
+                 'delivered_timestamp', 'delivery_latency')
+    
+    def __init__(self, message_id: str, target_username: str, stored_timestamp: float,
+                 expiry_timestamp: float, original_message: Dict):
+        self.reset(message_id, target_username, stored_timestamp, expiry_timestamp, original_message)
+    
+    def reset(self, message_id: str, target_username: str, stored_timestamp: float,
+              expiry_timestamp: float, original_message: Dict):
+        """Re-initialize all fields in place so a pooled instance can be reused"""
+        self.message_id = message_id
+        self.target_username = target_username
+        self.stored_timestamp = stored_timestamp
+        self.expiry_timestamp = expiry_timestamp
+        self.delivery_attempts = 0
+        self.is_delivered = False
+        self.original_message = original_message
+        self.delivered_timestamp = None
+        self.delivery_latency = None
+    
+    def to_dict(self) -> Dict:
+        """Convert offline message to dictionary for JSON serialization"""
+        return {
+            'message_id': self.message_id,
+            'target_username': self.target_username,
+            'stored_timestamp': self.stored_timestamp,
+            'expiry_timestamp': self.expiry_timestamp,
+            'delivery_attempts': self.delivery_attempts,
+            'is_delivered': self.is_delivered,
+            'original_message': self.original_message,
+            'delivered_timestamp': self.delivered_timestamp,
+            'delivery_latency': self.delivery_latency
+        }
+
 
 class OfflineQueue:
     """
@@ -35,18 +86,48 @@ class OfflineQueue:
             max_messages_per_user: Maximum messages stored per user
             message_expiry_hours: Hours after which messages expire
             auto_cleanup_interval: Seconds between automatic cleanup runs
-            delivery_callback: Function called when messages are delivered to user
+            delivery_callback: Function called as delivery_callback(username, messages)
+                when messages are delivered to a user; it returns True once they
+                reached the user, and a False return (or an exception) puts
+                them back on the queue
         """
         self.max_messages_per_user = max_messages_per_user
         self.message_expiry_seconds = message_expiry_hours * 3600
         self.auto_cleanup_interval = auto_cleanup_interval
         self.delivery_callback = delivery_callback
         
-        # User message queues (username -> deque of messages)
-        self.user_queues: Dict[str, deque] = defaultdict(lambda: deque(maxlen=self.max_messages_per_user))
+        # User message queues (username -> deque of OfflineMessage)
+        # Plain dict: only stores create entries, and emptied queues are removed,
+        # so lookups never leave empty deques behind
+        self.user_queues: Dict[str, deque] = {}
+        
+        # Free list of delivered/expired OfflineMessage objects, reused by stores so
+        # burst traffic doesn't churn the allocator. deque append/pop are atomic,
+        # so it needs no lock of its own
+        self._free_pool: deque = deque(maxlen=max_messages_per_user * 2)
+        
+        # Min-heap of (expiry_timestamp, username) with at most one entry per
+        # user, keyed on the expiry of that user's oldest message, so cleanup
+        # only visits users with messages due and the heap never outgrows the
+        # user count. Delivery, clears and evictions leave the entry as is: it
+        # can only be early, and cleanup re-pushes the real front when it pops it.
+        # _expiry_users holds the users that currently have an entry, including
+        # users whose entry cleanup has popped but not yet re-pushed.
+        self._expiry_heap: List[tuple] = []
+        self._expiry_users: Set[str] = set()
+        self._expiry_lock = threading.Lock()
+        
+        # Wakes the cleanup thread early: when a store pushes an expiry ahead of
+        # the current heap top, when the config changes, and on stop()
+        self._wakeup = threading.Event()
         
-        # Message metadata tracking
-        self.message_metadata: Dict[str, Dict] = {}  # message_id -> metadata
+        # Messages currently queued across all users, adjusted by every store,
+        # delivery, clear and cleanup so stats never have to re-count the queues
+        self._total_pending = 0
+        
+        # Sequence number making message IDs unique (next() on itertools.count
+        # is atomic under the GIL, so it needs no lock)
+        self._message_seq = itertools.count(1)
         
         # Statistics
         self.stats = {
@@ -60,183 +141,376 @@ class OfflineQueue:
             'delivery_success_rate': 0.0
         }
         
-        # Thread control
+        # Thread control. Each user's queue is guarded by one of LOCK_SHARDS locks
+        # picked by username hash, so users on different shards never contend;
+        # stats and the expiry heap have their own small locks. Lock order is
+        # shard lock(s) in index order, then _stats_lock or _expiry_lock; stats
+        # are normally recorded after the shard lock is released.
         self.running = True
-        self.lock = threading.Lock()
+        self._shards = [threading.Lock() for _ in range(LOCK_SHARDS)]
+        self._stats_lock = threading.Lock()
         
         # Start cleanup thread
         self.cleanup_thread = threading.Thread(target=self._cleanup_processor, daemon=True)
         self.cleanup_thread.start()
         
-        print(f"✅ OfflineQueue initialized: max_per_user={max_messages_per_user}, expiry={message_expiry_hours}h")
+        logger.info(f"✅ OfflineQueue initialized: max_per_user={max_messages_per_user}, expiry={message_expiry_hours}h")
+    
+    def _user_lock(self, username: str) -> threading.Lock:
+        """Get the shard lock guarding a user's queue"""
+        return self._shards[hash(username) & (LOCK_SHARDS - 1)]
+    
+    def _users_by_shard(self) -> List[tuple]:
+        """
+        Group a snapshot of the current usernames by the shard lock guarding them
+        
+        Returns:
+            List[tuple]: (shard lock, usernames) pairs; callers re-read each
+            user's queue once they hold the lock
+        """
+        shards = {}
+        for username in list(self.user_queues):
+            shards.setdefault(hash(username) & (LOCK_SHARDS - 1), []).append(username)
+        return [(self._shards[index], usernames) for index, usernames in shards.items()]
+    
+    def _acquire_all_shards(self):
+        """Acquire every shard lock, in index order, for whole-queue operations"""
+        for shard_lock in self._shards:
+            shard_lock.acquire()
+    
+    def _release_all_shards(self):
+        """Release every shard lock taken by _acquire_all_shards"""
+        for shard_lock in reversed(self._shards):
+            shard_lock.release()
+    
+    def _recycle(self, offline_message: OfflineMessage):
+        """
+        Return a no-longer-queued message object to the free pool
+        
+        Drops its original message reference so pooled objects don't keep
+        message dicts alive.
+        """
+        offline_message.original_message = None
+        self._free_pool.append(offline_message)
+    
+    def _store_message_for_user_locked(self, username: str, message: Dict,
+                                       stored_timestamp: float) -> tuple:
+        """
+        Append a message to a user's queue; the user's shard lock must be held
+        
+        Leaves the expiry heap (see _schedule_expiry_locked) and statistics to
+        the caller, so batch stores can update them once for all users.
+        
+        Args:
+            username: Target username
+            message: Message dictionary (treated as immutable once stored)
+            stored_timestamp: Time the message is stored at
+            
+        Returns:
+            tuple: (expiry timestamp, 1 if the queue grew else 0, queue length)
+        """
+        # Create message with offline queue metadata, reusing a pooled object if available
+        message_id = ('offline_' + username + '_' + format(int(stored_timestamp * 1000), 'x')
+                      + '_' + format(next(self._message_seq), 'x'))
+        expiry_timestamp = stored_timestamp + self.message_expiry_seconds
+        try:
+            offline_message = self._free_pool.pop()
+            offline_message.reset(message_id, username, stored_timestamp, expiry_timestamp, message)
+        except IndexError:
+            offline_message = OfflineMessage(message_id, username, stored_timestamp, expiry_timestamp, message)
+        
+        # Add to user's queue; a full deque drops its oldest message
+        user_queue = self.user_queues.get(username)
+        if user_queue is None:
+            user_queue = self.user_queues[username] = deque(maxlen=self.max_messages_per_user)
+        added = 0 if len(user_queue) == user_queue.maxlen else 1
+        user_queue.append(offline_message)
+        
+        return expiry_timestamp, added, len(user_queue)
+    
+    def _schedule_expiry_locked(self, username: str, expiry_timestamp: float) -> bool:
+        """
+        Give a user an expiry heap entry unless they already have one
+        
+        The user's shard lock and _expiry_lock must be held. A user with a
+        non-empty queue always has an entry, so a user without one is storing
+        into an empty queue and expiry_timestamp is that of their oldest message.
+        
+        Args:
+            username: User whose queue just received a message
+            expiry_timestamp: Expiry of the user's oldest message
+            
+        Returns:
+            bool: True if the new entry is now the earliest on the heap
+        """
+        if username in self._expiry_users:
+            return False
+        
+        heap = self._expiry_heap
+        entry = (expiry_timestamp, username)
+        earliest = not heap or entry < heap[0]
+        heapq.heappush(heap, entry)
+        self._expiry_users.add(username)
+        return earliest
     
     def store_message_for_user(self, username: str, message: Dict) -> bool:
         """
         Store a message for an offline user
         
+        The message is kept by reference, not copied, so the caller must not
+        mutate it after handing it over. Delivery builds a new dict from it.
+        
         Args:
             username: Target username
-            message: Message dictionary
+            message: Message dictionary (treated as immutable once stored)
             
         Returns:
             bool: True if message was stored successfully
         """
         try:
-            with self.lock:
-                # Create message with offline queue metadata
-                offline_message = {
-                    'message_id': f"offline_{username}_{int(time.time() * 1000)}_{len(self.user_queues[username])}",
-                    'target_username': username,
-                    'stored_timestamp': time.time(),
-                    'expiry_timestamp': time.time() + self.message_expiry_seconds,
-                    'delivery_attempts': 0,
-                    'is_delivered': False,
-                    'original_message': message.copy()
-                }
-                
-                # Add to user's queue
-                self.user_queues[username].append(offline_message)
-                
-                # Store metadata
-                self.message_metadata[offline_message['message_id']] = {
-                    'username': username,
-                    'stored_at': time.time(),
-                    'size_bytes': len(str(message)),
-                    'priority': message.get('priority', 3),
-                    'message_type': 'offline_storage'
-                }
-                
-                # Update statistics
-                self.stats['total_messages_stored'] += 1
-                self._update_user_stats()
-                
-                print(f"💾 Stored offline message for '{username}': '{message.get('text', '')[:30]}...' (Queue: {len(self.user_queues[username])})")
-                
-                return True
+            with self._user_lock(username):
+                expiry_timestamp, added, queue_size = self._store_message_for_user_locked(
+                    username, message, time.time())
                 
+                with self._expiry_lock:
+                    wake_cleanup = self._schedule_expiry_locked(username, expiry_timestamp)
+            
+            if wake_cleanup:
+                self._wakeup.set()
+            
+            # Update statistics once the shard lock is released
+            self._record_stats(stored=1, pending_delta=added)
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("💾 Stored offline message for '%s': '%s...' (Queue: %d)",
+                             username, message.get('text', '')[:30], queue_size)
+            
+            return True
+            
         except Exception as e:
-            print(f"❌ Error storing offline message: {e}")
+            logger.error(f"❌ Error storing offline message: {e}")
             return False
     
     def store_message_for_multiple_users(self, usernames: List[str], message: Dict) -> Dict:
         """
         Store a message for multiple offline users (like group messages)
         
+        Every user's queue shares the same message dict. Users are grouped by
+        shard so each shard lock is taken once, and the expiry heap and
+        statistics are updated once for the whole group.
+        
         Args:
             usernames: List of target usernames
-            message: Message dictionary
+            message: Message dictionary (treated as immutable once stored)
             
         Returns:
             Dict: Results for each user
         """
-        results = {}
+        results = dict.fromkeys(usernames)  # keeps the callers' user order
+        stored_count = 0
+        total_added = 0
+        wake_cleanup = False
+        stored_timestamp = time.time()
         
+        shards = {}
         for username in usernames:
-            success = self.store_message_for_user(username, message)
-            results[username] = {
-                'stored': success,
-                'queue_size': len(self.user_queues[username]) if success else 0
-            }
+            shards.setdefault(hash(username) & (LOCK_SHARDS - 1), []).append(username)
+        
+        # Shards in index order, matching the lock order used everywhere else
+        for index in sorted(shards):
+            with self._shards[index]:
+                stored_usernames = []
+                for username in shards[index]:
+                    try:
+                        expiry_timestamp, added, queue_size = self._store_message_for_user_locked(
+                            username, message, stored_timestamp)
+                    except Exception as e:
+                        logger.error(f"❌ Error storing offline message for '{username}': {e}")
+                        results[username] = {'stored': False, 'queue_size': 0}
+                        continue
+                    
+                    stored_usernames.append((username, expiry_timestamp))
+                    total_added += added
+                    results[username] = {'stored': True, 'queue_size': queue_size}
+                
+                # One _expiry_lock hold per shard, while the shard lock still
+                # guarantees these users' queues match their heap entries
+                if stored_usernames:
+                    with self._expiry_lock:
+                        for username, expiry_timestamp in stored_usernames:
+                            if self._schedule_expiry_locked(username, expiry_timestamp):
+                                wake_cleanup = True
+                    stored_count += len(stored_usernames)
+        
+        if stored_count:
+            if wake_cleanup:
+                self._wakeup.set()
+            
+            self._record_stats(stored=stored_count, pending_delta=total_added)
         
-        print(f"📨 Stored group message for {len(usernames)} users: {sum(1 for r in results.values() if r['stored'])} successful")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📨 Stored group message for %d users: %d successful",
+                         len(usernames), sum(1 for r in results.values() if r['stored']))
         
         return results
     
-    def deliver_offline_messages(self, username: str, user_manager) -> List[Dict]:
+    def deliver_offline_messages(self, username: str, is_online: Callable[[str], bool]) -> List[Dict]:
         """
         Deliver all offline messages for a user when they come online
         
         Args:
             username: Username that came online
-            user_manager: UserManager instance to check online status
+            is_online: Online-status check (e.g. UserManager.is_user_online),
+                called before the user's queue lock is taken
             
         Returns:
             List[Dict]: Messages that were delivered
         """
         try:
-            with self.lock:
-                if username not in self.user_queues or not self.user_queues[username]:
-                    print(f"📭 No offline messages for '{username}'")
-                    return []
-                
-                # Check if user is actually online
-                if not user_manager.users.get(username, {}).get('is_online', False):
-                    print(f"⚠️ User '{username}' not marked as online, skipping delivery")
+            # Check if user is actually online, outside the queue lock
+            if not is_online(username):
+                logger.warning("⚠️ User '%s' not marked as online, skipping delivery", username)
+                return []
+            
+            with self._user_lock(username):
+                # Get all messages for user
+                user_queue = self.user_queues.get(username)
+                if not user_queue:
+                    logger.debug("📭 No offline messages for '%s'", username)
                     return []
                 
-                # Get all messages for user
-                user_queue = self.user_queues[username]
+                pending_before = len(user_queue)
+                expired_count = 0
                 delivered_messages = []
-                failed_deliveries = []
+                delivered_entries = []  # OfflineMessage objects behind delivered_messages
+                
+                # One clock read for the whole delivery: the queue is capped at
+                # max_messages_per_user, so the loop is short
+                delivery_time = time.time()
                 
                 # Process all messages in user's queue
                 while user_queue:
                     offline_message = user_queue.popleft()
                     
                     # Check if message has expired
-                    if time.time() > offline_message['expiry_timestamp']:
-                        self.stats['total_messages_expired'] += 1
-                        print(f"⏰ Expired message for '{username}': '{offline_message['original_message'].get('text', '')[:30]}...'")
-                        
-                        # Clean up metadata
-                        if offline_message['message_id'] in self.message_metadata:
-                            del self.message_metadata[offline_message['message_id']]
+                    if delivery_time > offline_message.expiry_timestamp:
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("⏰ Expired message for '%s': '%s...'",
+                                         username, offline_message.original_message.get('text', '')[:30])
                         
+                        expired_count += 1
+                        self._recycle(offline_message)
                         continue
                     
-                    # Attempt delivery
-                    offline_message['delivery_attempts'] += 1
-                    delivery_time = time.time()
+                    # Mark as delivered
+                    offline_message.delivery_attempts += 1
+                    offline_message.is_delivered = True
+                    offline_message.delivered_timestamp = delivery_time
+                    offline_message.delivery_latency = delivery_time - offline_message.stored_timestamp
                     
-                    try:
-                        # Mark as delivered
-                        offline_message['is_delivered'] = True
-                        offline_message['delivered_timestamp'] = delivery_time
-                        offline_message['delivery_latency'] = delivery_time - offline_message['stored_timestamp']
-                        
-                        # Add delivery metadata to original message
-                        message_for_delivery = offline_message['original_message'].copy()
-                        message_for_delivery.update({
-                            'offline_delivery': True,
-                            'stored_duration': delivery_time - offline_message['stored_timestamp'],
-                            'offline_message_id': offline_message['message_id'],
-                            'was_offline_message': True
-                        })
-                        
-                        delivered_messages.append(message_for_delivery)
-                        self.stats['total_messages_delivered'] += 1
-                        
-                        print(f"📬 Delivered offline message to '{username}': '{message_for_delivery.get('text', '')[:30]}...'")
-                        
-                    except Exception as delivery_error:
-                        print(f"❌ Failed to deliver message to '{username}': {delivery_error}")
-                        failed_deliveries.append(offline_message)
-                
-                # Re-queue failed deliveries (if any)
-                for failed_msg in failed_deliveries:
-                    if failed_msg['delivery_attempts'] < 3:  # Max 3 delivery attempts
-                        user_queue.append(failed_msg)
-                    else:
-                        print(f"💔 Permanently failed delivery for '{username}': {failed_msg['message_id']}")
-                
-                # Update statistics
-                self._update_user_stats()
+                    # Build the delivered message with its delivery metadata in one dict
+                    message_for_delivery = {
+                        **offline_message.original_message,
+                        'offline_delivery': True,
+                        'stored_duration': offline_message.delivery_latency,
+                        'offline_message_id': offline_message.message_id,
+                        'was_offline_message': True
+                    }
+                    
+                    delivered_messages.append(message_for_delivery)
+                    delivered_entries.append(offline_message)
+                    
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("📬 Delivered offline message to '%s': '%s...'",
+                                     username, message_for_delivery.get('text', '')[:30])
                 
-                # Call delivery callback if provided
+                # Call delivery callback if provided; it is the only step that can fail
                 if self.delivery_callback and delivered_messages:
                     try:
-                        self.delivery_callback(username, delivered_messages)
+                        delivered = self.delivery_callback(username, delivered_messages)
                     except Exception as e:
-                        print(f"❌ Offline delivery callback error: {e}")
+                        logger.error(f"❌ Offline delivery callback error: {e}")
+                        delivered = False
+                    
+                    if not delivered:
+                        self._requeue_failed_delivery(username, user_queue, delivered_entries)
+                        delivered_entries = []
+                        delivered_messages = []
                 
-                print(f"📦 OFFLINE DELIVERY COMPLETE for '{username}': {len(delivered_messages)} messages delivered")
+                for offline_message in delivered_entries:
+                    self._recycle(offline_message)
                 
-                return delivered_messages
+                pending_removed = pending_before - len(user_queue)
                 
+                # Remove the emptied queue here, since cleanup only visits users with expiring messages
+                if not user_queue:
+                    del self.user_queues[username]
+            
+            # Update statistics once the shard lock is released
+            self._record_stats(delivered=len(delivered_messages), expired=expired_count,
+                               pending_delta=-pending_removed)
+            
+            logger.info("📦 OFFLINE DELIVERY COMPLETE for '%s': %d messages delivered",
+                        username, len(delivered_messages))
+            
+            return delivered_messages
+            
         except Exception as e:
-            print(f"❌ Error delivering offline messages: {e}")
+            logger.error(f"❌ Error delivering offline messages: {e}")
             return []
     
+    def _requeue_failed_delivery(self, username: str, user_queue: deque,
+                                 offline_messages: List[OfflineMessage]):
+        """
+        Put messages whose delivery callback failed back at the front of the queue
+        
+        The user's shard lock must be held. Messages that have used up their
+        delivery attempts are dropped instead.
+        
+        Args:
+            username: Username the delivery was for
+            user_queue: The user's message queue
+            offline_messages: Messages handed to the failed callback, oldest first
+        """
+        retry_messages = []
+        for offline_message in offline_messages:
+            if offline_message.delivery_attempts < 3:  # Max 3 delivery attempts
+                offline_message.is_delivered = False
+                offline_message.delivered_timestamp = None
+                offline_message.delivery_latency = None
+                retry_messages.append(offline_message)
+            else:
+                logger.error(f"💔 Permanently failed delivery for '{username}': {offline_message.message_id}")
+                self._recycle(offline_message)
+        
+        # extendleft reverses its input, so feed it newest first to keep FIFO order
+        user_queue.extendleft(reversed(retry_messages))
+    
+    @staticmethod
+    def _first_valid_index(queue: deque, current_time: float) -> int:
+        """
+        Binary search for the first non-expired message in a user's queue
+        
+        Messages are appended in stored order with a fixed expiry (and
+        update_config keeps it that way), so the queue is sorted by
+        expiry_timestamp and the expired ones form a prefix.
+        
+        Args:
+            queue: User's message queue
+            current_time: Time to check expiry against
+            
+        Returns:
+            int: Index of the first message with current_time <= expiry_timestamp
+        """
+        low, high = 0, len(queue)
+        while low < high:
+            mid = (low + high) // 2
+            if queue[mid].expiry_timestamp < current_time:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+    
     def get_offline_message_count(self, username: str) -> int:
         """
         Get number of offline messages waiting for a user
@@ -247,19 +521,48 @@ class OfflineQueue:
         Returns:
             int: Number of pending messages
         """
-        with self.lock:
-            if username not in self.user_queues:
+        with self._user_lock(username):
+            queue = self.user_queues.get(username)
+            if queue is None:
                 return 0
             
             # Count non-expired messages
             current_time = time.time()
-            valid_messages = 0
             
-            for msg in self.user_queues[username]:
-                if current_time <= msg['expiry_timestamp']:
-                    valid_messages += 1
+            return len(queue) - self._first_valid_index(queue, current_time)
+    
+    def get_offline_message_counts(self, usernames: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        """
+        Get the number of offline messages waiting for many users at once
+        
+        One pass over the users that have queues, taking each shard lock
+        once, instead of a locked lookup per user.
+        
+        Args:
+            usernames: Users to count for; all users with queues if None
             
-            return valid_messages
+        Returns:
+            Dict[str, int]: Pending message count per user; users with no
+            pending messages are left out
+        """
+        wanted = None if usernames is None else set(usernames)
+        counts = {}
+        current_time = time.time()
+        
+        for shard_lock, queued_usernames in self._users_by_shard():
+            with shard_lock:
+                for username in queued_usernames:
+                    if wanted is not None and username not in wanted:
+                        continue
+                    queue = self.user_queues.get(username)
+                    if not queue:
+                        continue
+                    
+                    valid_messages = len(queue) - self._first_valid_index(queue, current_time)
+                    if valid_messages > 0:
+                        counts[username] = valid_messages
+        
+        return counts
     
     def get_all_offline_users(self) -> List[Dict]:
         """
@@ -271,23 +574,26 @@ class OfflineQueue:
         offline_users = []
         current_time = time.time()
         
-        with self.lock:
-            for username, queue in self.user_queues.items():
-                if queue:  # Has messages
-                    valid_messages = sum(1 for msg in queue if current_time <= msg['expiry_timestamp'])
+        for shard_lock, usernames in self._users_by_shard():
+            with shard_lock:
+                for username in usernames:
+                    queue = self.user_queues.get(username)
+                    if not queue:  # No messages
+                        continue
+                    
+                    # The first valid message is also the oldest valid one
+                    first_valid = self._first_valid_index(queue, current_time)
+                    valid_messages = len(queue) - first_valid
                     
                     if valid_messages > 0:
-                        oldest_message_time = min(msg['stored_timestamp'] for msg in queue 
-                                                if current_time <= msg['expiry_timestamp'])
-                        
                         offline_users.append({
                             'username': username,
                             'message_count': valid_messages,
-                            'oldest_message_age': current_time - oldest_message_time,
+                            'oldest_message_age': current_time - queue[first_valid].stored_timestamp,
                             'queue_size': len(queue)
                         })
         
-        return sorted(offline_users, key=lambda x: x['oldest_message_age'], reverse=True)
+        return sorted(offline_users, key=itemgetter('oldest_message_age'), reverse=True)
     
     def peek_user_messages(self, username: str, limit: int = 5) -> List[Dict]:
         """
@@ -300,23 +606,27 @@ class OfflineQueue:
         Returns:
             List[Dict]: Preview of pending messages
         """
-        with self.lock:
-            if username not in self.user_queues:
+        with self._user_lock(username):
+            queue = self.user_queues.get(username)
+            if queue is None:
                 return []
             
             preview_messages = []
             current_time = time.time()
             
-            for msg in list(self.user_queues[username])[:limit]:
-                if current_time <= msg['expiry_timestamp']:
-                    preview_messages.append({
-                        'message_id': msg['message_id'],
-                        'text': msg['original_message'].get('text', '')[:100],
-                        'from_user': msg['original_message'].get('user', 'Unknown'),
-                        'priority': msg['original_message'].get('priority', 3),
-                        'stored_age': current_time - msg['stored_timestamp'],
-                        'expires_in': msg['expiry_timestamp'] - current_time
-                    })
+            # Skip the expired prefix; everything after it is still valid
+            start = self._first_valid_index(queue, current_time)
+            
+            # islice walks just the previewed span instead of copying the whole deque
+            for msg in itertools.islice(queue, start, start + limit):
+                preview_messages.append({
+                    'message_id': msg.message_id,
+                    'text': msg.original_message.get('text', '')[:100],
+                    'from_user': msg.original_message.get('user', 'Unknown'),
+                    'priority': msg.original_message.get('priority', 3),
+                    'stored_age': current_time - msg.stored_timestamp,
+                    'expires_in': msg.expiry_timestamp - current_time
+                })
             
             return preview_messages
     
@@ -330,38 +640,42 @@ class OfflineQueue:
         Returns:
             int: Number of messages cleared
         """
-        with self.lock:
-            if username not in self.user_queues:
+        with self._user_lock(username):
+            # Detach the user's queue, then recycle its messages
+            queue = self.user_queues.pop(username, None)
+            if queue is None:
                 return 0
             
-            cleared_count = len(self.user_queues[username])
-            
-            # Clean up metadata
-            for msg in self.user_queues[username]:
-                if msg['message_id'] in self.message_metadata:
-                    del self.message_metadata[msg['message_id']]
-            
-            # Clear the queue
-            self.user_queues[username].clear()
-            
-            # Remove empty queue
-            if not self.user_queues[username]:
-                del self.user_queues[username]
-            
-            self._update_user_stats()
-            
-            print(f"🗑️ Cleared {cleared_count} offline messages for '{username}'")
-            return cleared_count
+            cleared_count = len(queue)
+            for msg in queue:
+                self._recycle(msg)
+        
+        self._record_stats(pending_delta=-cleared_count)
+        
+        logger.info(f"🗑️ Cleared {cleared_count} offline messages for '{username}'")
+        return cleared_count
     
     def _cleanup_processor(self):
         """
         Background thread that cleans up expired messages
+        
+        Sleeps until the earliest expiry on the heap is due, capped at
+        auto_cleanup_interval, and is woken early through _wakeup.
         """
-        print("🧹 Offline queue cleanup thread started")
+        logger.debug("🧹 Offline queue cleanup thread started")
         
         while self.running:
             try:
-                time.sleep(self.auto_cleanup_interval)
+                # Clear before reading the heap top so a wakeup set after the read isn't lost
+                self._wakeup.clear()
+                
+                with self._expiry_lock:
+                    next_expiry = self._expiry_heap[0][0] if self._expiry_heap else None
+                
+                timeout = self.auto_cleanup_interval
+                if next_expiry is not None:
+                    timeout = min(timeout, max(0.0, next_expiry - time.time()))
+                self._wakeup.wait(timeout)
                 
                 if not self.running:
                     break
@@ -369,88 +683,104 @@ class OfflineQueue:
                 self._cleanup_expired_messages()
                 
             except Exception as e:
-                print(f"❌ Cleanup processor error: {e}")
-                time.sleep(10)  # Wait longer on error
+                logger.error(f"❌ Cleanup processor error: {e}")
+                self._wakeup.wait(10)  # Wait longer on error
     
     def _cleanup_expired_messages(self):
         """
         Remove expired messages from all user queues
+        
+        Pops the due entries off the expiry heap, so only users with
+        expiring messages are visited, rather than a scan of every queued
+        message. A user whose queue still has messages gets a new entry for
+        its new oldest message.
         """
         try:
-            with self.lock:
-                current_time = time.time()
-                total_expired = 0
-                empty_users = []
-                
-                for username, queue in self.user_queues.items():
-                    expired_messages = []
-                    remaining_messages = deque(maxlen=self.max_messages_per_user)
-                    
-                    # Check each message in user's queue
-                    while queue:
-                        msg = queue.popleft()
-                        
-                        if current_time <= msg['expiry_timestamp']:
-                            # Message still valid
-                            remaining_messages.append(msg)
-                        else:
-                            # Message expired
-                            expired_messages.append(msg)
-                            total_expired += 1
-                            
-                            # Clean up metadata
-                            if msg['message_id'] in self.message_metadata:
-                                del self.message_metadata[msg['message_id']]
+            current_time = time.time()
+            total_expired = 0
+            empty_users = []
+            
+            # Collect the users that have messages due
+            due_users = []
+            with self._expiry_lock:
+                heap = self._expiry_heap
+                while heap and heap[0][0] < current_time:
+                    # The user stays in _expiry_users until the re-push below, so
+                    # a store in between can't schedule one of its newer messages
+                    due_users.append(heapq.heappop(heap)[1])
+            
+            for username in due_users:
+                with self._user_lock(username):
+                    queue = self.user_queues.get(username)
+                    if queue is None:
+                        with self._expiry_lock:
+                            self._expiry_users.discard(username)
+                        continue
                     
-                    # Update user's queue with remaining messages
-                    self.user_queues[username] = remaining_messages
+                    expired_messages = []
                     
-                    # Mark users with no messages for removal
-                    if not remaining_messages:
-                        empty_users.append(username)
+                    # Queues are sorted by expiry, so expired messages sit at the front
+                    while queue and queue[0].expiry_timestamp < current_time:
+                        expired_messages.append(queue.popleft())
                     
                     if expired_messages:
-                        print(f"⏰ Cleaned {len(expired_messages)} expired messages for '{username}'")
-                
-                # Remove empty user queues
-                for username in empty_users:
-                    del self.user_queues[username]
-                
-                # Update statistics
-                if total_expired > 0:
-                    self.stats['total_messages_expired'] += total_expired
-                    self.stats['total_cleanup_runs'] += 1
-                    self._update_user_stats()
+                        total_expired += len(expired_messages)
+                        for msg in expired_messages:
+                            self._recycle(msg)
+                        logger.debug("⏰ Cleaned %d expired messages for '%s'", len(expired_messages), username)
                     
-                    print(f"🧹 CLEANUP COMPLETE: {total_expired} expired messages removed, {len(empty_users)} empty queues cleared")
+                    # Remove empty user queues; otherwise schedule the new oldest message
+                    with self._expiry_lock:
+                        if not queue:
+                            del self.user_queues[username]
+                            empty_users.append(username)
+                            self._expiry_users.discard(username)
+                        else:
+                            heapq.heappush(self._expiry_heap, (queue[0].expiry_timestamp, username))
+                            self._expiry_users.add(username)
+            
+            # Update statistics
+            if total_expired > 0:
+                self._record_stats(expired=total_expired, pending_delta=-total_expired, cleanup_run=True)
                 
+                logger.info(f"🧹 CLEANUP COMPLETE: {total_expired} expired messages removed, {len(empty_users)} empty queues cleared")
+            
         except Exception as e:
-            print(f"❌ Cleanup error: {e}")
+            logger.error(f"❌ Cleanup error: {e}")
     
-    def _update_user_stats(self):
+    def _record_stats(self, stored: int = 0, delivered: int = 0, expired: int = 0,
+                      pending_delta: int = 0, cleanup_run: bool = False):
         """
-        Update user-related statistics
+        Apply counter changes and refresh the user-related statistics
+        
+        One short _stats_lock hold per operation, taken after the shard lock is
+        released, so stats never extend a shard's critical section. O(1):
+        works from the running _total_pending count. The oldest undelivered
+        age is only computed when status is requested.
+        
+        Args:
+            stored: Messages stored
+            delivered: Messages delivered
+            expired: Messages expired
+            pending_delta: Change in the number of queued messages
+            cleanup_run: True if this records a cleanup run
         """
-        with self.lock:
-            self.stats['users_with_offline_messages'] = len(self.user_queues)
+        user_count = len(self.user_queues)
+        
+        with self._stats_lock:
+            self.stats['total_messages_stored'] += stored
+            self.stats['total_messages_delivered'] += delivered
+            self.stats['total_messages_expired'] += expired
+            if cleanup_run:
+                self.stats['total_cleanup_runs'] += 1
+            self._total_pending += pending_delta
             
-            if self.user_queues:
-                total_messages = sum(len(queue) for queue in self.user_queues.values())
-                self.stats['average_messages_per_user'] = total_messages / len(self.user_queues)
-                
-                # Find oldest undelivered message
-                current_time = time.time()
-                oldest_age = 0
-                
-                for queue in self.user_queues.values():
-                    for msg in queue:
-                        age = current_time - msg['stored_timestamp']
-                        oldest_age = max(oldest_age, age)
-                
-                self.stats['oldest_undelivered_age'] = oldest_age
+            self.stats['users_with_offline_messages'] = user_count
+            
+            if user_count:
+                self.stats['average_messages_per_user'] = self._total_pending / user_count
             else:
                 self.stats['average_messages_per_user'] = 0.0
-                self.stats['oldest_undelivered_age'] = 0.0
             
             # Calculate delivery success rate
             total_attempted = self.stats['total_messages_delivered'] + self.stats['total_messages_expired']
@@ -466,30 +796,41 @@ class OfflineQueue:
         Returns:
             Dict: Current status information
         """
-        with self.lock:
-            # Calculate current totals
-            total_pending_messages = sum(len(queue) for queue in self.user_queues.values())
-            
-            user_breakdown = {}
-            for username, queue in self.user_queues.items():
-                if queue:
-                    user_breakdown[username] = {
-                        'message_count': len(queue),
-                        'oldest_message_age': time.time() - queue[0]['stored_timestamp'] if queue else 0
-                    }
-            
-            return {
-                'total_pending_messages': total_pending_messages,
-                'users_with_messages': len(self.user_queues),
-                'user_breakdown': user_breakdown,
-                'is_running': self.running,
-                'configuration': {
-                    'max_messages_per_user': self.max_messages_per_user,
-                    'message_expiry_hours': self.message_expiry_seconds / 3600,
-                    'cleanup_interval_minutes': self.auto_cleanup_interval / 60
-                },
-                'statistics': self.stats.copy()
-            }
+        # Calculate current totals
+        current_time = time.time()
+        user_breakdown = {}
+        oldest_age = 0.0
+        
+        for shard_lock, usernames in self._users_by_shard():
+            with shard_lock:
+                for username in usernames:
+                    queue = self.user_queues.get(username)
+                    if queue:
+                        # Each queue is FIFO, so its front message is its oldest
+                        oldest_message_age = current_time - queue[0].stored_timestamp
+                        oldest_age = max(oldest_age, oldest_message_age)
+                        user_breakdown[username] = {
+                            'message_count': len(queue),
+                            'oldest_message_age': oldest_message_age
+                        }
+        
+        with self._stats_lock:
+            self.stats['oldest_undelivered_age'] = oldest_age
+            statistics = self.stats.copy()
+            total_pending_messages = self._total_pending
+        
+        return {
+            'total_pending_messages': total_pending_messages,
+            'users_with_messages': len(self.user_queues),
+            'user_breakdown': user_breakdown,
+            'is_running': self.running,
+            'configuration': {
+                'max_messages_per_user': self.max_messages_per_user,
+                'message_expiry_hours': self.message_expiry_seconds / 3600,
+                'cleanup_interval_minutes': self.auto_cleanup_interval / 60
+            },
+            'statistics': statistics
+        }
     
     def force_cleanup(self) -> Dict:
         """
@@ -498,7 +839,7 @@ class OfflineQueue:
         Returns:
             Dict: Cleanup results
         """
-        print("🧹 Forcing immediate cleanup...")
+        logger.info("🧹 Forcing immediate cleanup...")
         
         before_stats = self.get_queue_status()
         self._cleanup_expired_messages()
@@ -513,30 +854,33 @@ class OfflineQueue:
             'cleanup_timestamp': time.time()
         }
         
-        print(f"🧹 FORCED CLEANUP RESULTS: {cleanup_results['messages_expired']} messages expired")
+        logger.info(f"🧹 FORCED CLEANUP RESULTS: {cleanup_results['messages_expired']} messages expired")
         
         return cleanup_results
     
-    def handle_user_online(self, username: str, user_manager) -> Optional[Dict]:
+    def handle_user_online(self, username: str, is_online: Callable[[str], bool]) -> Optional[Dict]:
         """
         Handle when a user comes online - deliver their offline messages
         
         Args:
             username: Username that came online
-            user_manager: UserManager instance
+            is_online: Online-status check (e.g. UserManager.is_user_online)
             
         Returns:
             Optional[Dict]: Delivery summary or None if no messages
         """
-        message_count = self.get_offline_message_count(username)
-        
-        if message_count == 0:
+        # Cheap emptiness check; delivery itself skips any expired messages
+        queue = self.user_queues.get(username)
+        if not queue:
             return None
         
-        print(f"👋 User '{username}' came online with {message_count} offline messages waiting")
+        logger.info(f"👋 User '{username}' came online with {len(queue)} offline messages waiting")
         
         # Deliver messages
-        delivered_messages = self.deliver_offline_messages(username, user_manager)
+        delivered_messages = self.deliver_offline_messages(username, is_online)
+        
+        if not delivered_messages:
+            return None
         
         delivery_summary = {
             'username': username,
@@ -566,32 +910,10 @@ class OfflineQueue:
             'queue_ready': True
         }
         
-        print(f"👤 User '{username}' went offline (had {current_count} pending messages)")
+        logger.info(f"👤 User '{username}' went offline (had {current_count} pending messages)")
         
         return offline_summary
     
-    def get_offline_message_count(self, username: str) -> int:
-        """
-        Get number of valid (non-expired) offline messages for a user
-        
-        Args:
-            username: Username to check
-            
-        Returns:
-            int: Number of pending messages
-        """
-        if username not in self.user_queues:
-            return 0
-        
-        current_time = time.time()
-        valid_count = 0
-        
-        for msg in self.user_queues[username]:
-            if current_time <= msg['expiry_timestamp']:
-                valid_count += 1
-        
-        return valid_count
-    
     def clear_all_messages(self) -> Dict:
         """
         Clear all offline messages for all users
@@ -599,18 +921,26 @@ class OfflineQueue:
         Returns:
             Dict: Clear operation results
         """
-        with self.lock:
+        self._acquire_all_shards()
+        try:
             total_messages = sum(len(queue) for queue in self.user_queues.values())
             total_users = len(self.user_queues)
             
             # Clear all queues
             self.user_queues.clear()
-            self.message_metadata.clear()
             
-            # Reset relevant stats
-            self.stats['users_with_offline_messages'] = 0
-            self.stats['average_messages_per_user'] = 0.0
-            self.stats['oldest_undelivered_age'] = 0.0
+            with self._expiry_lock:
+                self._expiry_heap.clear()
+                self._expiry_users.clear()
+            
+            with self._stats_lock:
+                # Reset relevant stats
+                self._total_pending = 0
+                self.stats['users_with_offline_messages'] = 0
+                self.stats['average_messages_per_user'] = 0.0
+                self.stats['oldest_undelivered_age'] = 0.0
+        finally:
+            self._release_all_shards()
         
         clear_results = {
             'messages_cleared': total_messages,
@@ -618,7 +948,7 @@ class OfflineQueue:
             'clear_timestamp': time.time()
         }
         
-        print(f"🧹 CLEARED ALL: {total_messages} messages for {total_users} users")
+        logger.info(f"🧹 CLEARED ALL: {total_messages} messages for {total_users} users")
         
         return clear_results
     
@@ -634,34 +964,72 @@ class OfflineQueue:
             message_expiry_hours: New expiry time in hours
             auto_cleanup_interval: New cleanup interval in seconds
         """
-        with self.lock:
+        self._acquire_all_shards()
+        try:
             if max_messages_per_user is not None:
                 self.max_messages_per_user = max(10, max_messages_per_user)
                 
-                # Update existing queues with new limit
+                # Update existing queues with new limit (a smaller limit drops the oldest messages)
                 for username in self.user_queues:
                     new_queue = deque(self.user_queues[username], maxlen=self.max_messages_per_user)
                     self.user_queues[username] = new_queue
+                
+                with self._stats_lock:
+                    self._total_pending = sum(len(queue) for queue in self.user_queues.values())
             
             if message_expiry_hours is not None:
-                self.message_expiry_seconds = max(1, message_expiry_hours) * 3600
+                new_expiry_seconds = max(1, message_expiry_hours) * 3600
+                if new_expiry_seconds < self.message_expiry_seconds:
+                    self._shorten_queued_expiries(new_expiry_seconds)
+                self.message_expiry_seconds = new_expiry_seconds
             
             if auto_cleanup_interval is not None:
                 self.auto_cleanup_interval = max(60, auto_cleanup_interval)
+        finally:
+            self._release_all_shards()
+        
+        # Let the cleanup thread recompute its wait under the new settings
+        self._wakeup.set()
+        
+        logger.info(f"⚙️ Offline queue config updated: max_per_user={self.max_messages_per_user}, expiry={self.message_expiry_seconds/3600}h")
+    
+    def _shorten_queued_expiries(self, expiry_seconds: int):
+        """
+        Apply a shortened expiry to messages already queued; all shard locks must be held
+        
+        Each message expires at the earlier of its current expiry and
+        stored_timestamp + expiry_seconds. Both are non-decreasing along a
+        queue, so queues stay sorted by expiry and newer messages never expire
+        ahead of older ones. The expiry heap is rebuilt to match, with one
+        entry per queued user.
         
-        print(f"⚙️ Offline queue config updated: max_per_user={self.max_messages_per_user}, expiry={self.message_expiry_seconds/3600}h")
+        Args:
+            expiry_seconds: New expiry time in seconds
+        """
+        expiry_entries = []
+        for username, queue in self.user_queues.items():
+            for msg in queue:
+                msg.expiry_timestamp = min(msg.expiry_timestamp, msg.stored_timestamp + expiry_seconds)
+            if queue:
+                expiry_entries.append((queue[0].expiry_timestamp, username))
+        
+        heapq.heapify(expiry_entries)
+        with self._expiry_lock:
+            self._expiry_heap = expiry_entries
+            self._expiry_users = {username for _, username in expiry_entries}
     
     def stop(self):
         """
         Stop the offline queue and cleanup thread
         """
         self.running = False
+        self._wakeup.set()
         
         # Wait for cleanup thread to finish
         if self.cleanup_thread.is_alive():
             self.cleanup_thread.join(timeout=2.0)
         
-        print(f"⏹️ Offline queue stopped. Final stats: {self.stats}")
+        logger.info(f"⏹️ Offline queue stopped. Final stats: {self.stats}")
     
     def export_offline_log(self) -> Dict:
         """
@@ -670,42 +1038,51 @@ class OfflineQueue:
         Returns:
             Dict: Comprehensive offline queue data
         """
-        with self.lock:
-            user_details = {}
-            
-            for username, queue in self.user_queues.items():
-                messages_info = []
-                for msg in queue:
-                    messages_info.append({
-                        'message_id': msg['message_id'],
-                        'stored_timestamp': msg['stored_timestamp'],
-                        'expiry_timestamp': msg['expiry_timestamp'],
-                        'delivery_attempts': msg['delivery_attempts'],
-                        'is_delivered': msg['is_delivered'],
-                        'text_preview': msg['original_message'].get('text', '')[:50],
-                        'priority': msg['original_message'].get('priority', 3)
-                    })
-                
-                user_details[username] = {
-                    'message_count': len(queue),
-                    'messages': messages_info
-                }
-            
-            return {
-                'timestamp': datetime.now().isoformat(),
-                'configuration': {
-                    'max_messages_per_user': self.max_messages_per_user,
-                    'message_expiry_hours': self.message_expiry_seconds / 3600,
-                    'auto_cleanup_interval': self.auto_cleanup_interval
-                },
-                'current_state': {
-                    'total_users_with_messages': len(self.user_queues),
-                    'total_pending_messages': sum(len(queue) for queue in self.user_queues.values()),
-                    'is_running': self.running
-                },
-                'statistics': self.stats.copy(),
-                'user_details': user_details
-            }
+        user_details = {}
+        total_pending_messages = 0
+        
+        for shard_lock, usernames in self._users_by_shard():
+            with shard_lock:
+                for username in usernames:
+                    queue = self.user_queues.get(username)
+                    if queue is None:
+                        continue
+                    
+                    # Plain str/number fields only, so the app can hand the log straight to orjson
+                    messages_info = [{
+                        'message_id': msg.message_id,
+                        'stored_timestamp': msg.stored_timestamp,
+                        'expiry_timestamp': msg.expiry_timestamp,
+                        'delivery_attempts': msg.delivery_attempts,
+                        'is_delivered': msg.is_delivered,
+                        'text_preview': msg.original_message.get('text', '')[:50],
+                        'priority': msg.original_message.get('priority', 3)
+                    } for msg in queue]
+                    
+                    total_pending_messages += len(queue)
+                    user_details[username] = {
+                        'message_count': len(queue),
+                        'messages': messages_info
+                    }
+        
+        with self._stats_lock:
+            statistics = self.stats.copy()
+        
+        return {
+            'timestamp': datetime.now().isoformat(),
+            'configuration': {
+                'max_messages_per_user': self.max_messages_per_user,
+                'message_expiry_hours': self.message_expiry_seconds / 3600,
+                'auto_cleanup_interval': self.auto_cleanup_interval
+            },
+            'current_state': {
+                'total_users_with_messages': len(user_details),
+                'total_pending_messages': total_pending_messages,
+                'is_running': self.running
+            },
+            'statistics': statistics,
+            'user_details': user_details
+        }
 
 
 # Example callback function for offline message delivery
@@ -721,10 +1098,14 @@ def offline_delivery_callback(username: str, delivered_messages: List[Dict]):
     
     for msg in delivered_messages:
         print(f"   📬 {msg.get('user', 'Unknown')}: {msg.get('text', '')[:40]}...")
+    
+    return True
 
 
 # Example usage and testing
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    
     # Create offline queue with callback
     offline_queue = OfflineQueue(
         max_messages_per_user=50,
@@ -749,6 +1130,9 @@ if __name__ == "__main__":
         def set_user_offline(self, username):
             if username in self.users:
                 self.users[username]['is_online'] = False
+        
+        def is_user_online(self, username):
+            return self.users.get(username, {}).get('is_online', False)
     
     user_manager = MockUserManager()
     
@@ -781,7 +1165,7 @@ if __name__ == "__main__":
     print(f"\n👋 Alice comes online...")
     user_manager.set_user_online('alice')
     
-    delivery_summary = offline_queue.handle_user_online('alice', user_manager)
+    delivery_summary = offline_queue.handle_user_online('alice', user_manager.is_user_online)
     if delivery_summary:
         print(f"📦 Delivery summary: {delivery_summary['messages_delivered']} messages delivered")
     
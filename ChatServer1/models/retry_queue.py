@@ -3,14 +3,80 @@ Retry Queue Implementation
 Handles failed message delivery with exponential backoff using Deque
 """
 
+import heapq
+import itertools
+import logging
+import random
 import time
 import threading
 import math
+import types
 from collections import deque
-from typing import Dict, List, Optional, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Mapping, Optional, Callable
 from datetime import datetime
 import json
 
+logger = logging.getLogger("chat.retry_queue")
+
+# Backoff jitter strategies (see AWS "Exponential Backoff And Jitter"):
+# - none: the exact exponential delay
+# - full: uniform between 0 and the exponential delay
+# - decorrelated: uniform between initial_delay and 3x the entry's previous delay
+JITTER_MODES = ('none', 'full', 'decorrelated')
+
+# Bounds on how many due entries the processor dispatches in one pass
+MIN_DISPATCH_BATCH = 1
+MAX_DISPATCH_BATCH = 256
+
+
+class RetryEntry:
+    """
+    A failed message waiting to be retried, with its retry tracking fields
+    
+    Uses __slots__ instead of a per-entry dict to keep long waiting queues
+    small and field access cheap.
+    """
+    __slots__ = ('message', 'retry_count', 'max_retries', 'error_reason',
+                 'original_timestamp', 'added_to_retry', 'next_retry_time',
+                 'retry_history', 'retry_id', 'last_attempt', 'last_delay')
+    
+    def __init__(self, message: Mapping, max_retries: int, error_reason: str,
+                 original_timestamp: float, added_to_retry: float,
+                 next_retry_time: float, retry_id: int):
+        self.message = message
+        self.retry_count = 0
+        self.max_retries = max_retries
+        self.error_reason = error_reason
+        self.original_timestamp = original_timestamp
+        self.added_to_retry = added_to_retry
+        self.next_retry_time = next_retry_time
+        self.retry_history = []
+        self.retry_id = retry_id
+        self.last_attempt = None
+        self.last_delay = None
+    
+    @property
+    def label(self) -> str:
+        """Human-readable retry id, only formatted when something displays it"""
+        return f"retry_{self.retry_id}"
+    
+    def to_dict(self) -> Dict:
+        """Convert retry entry to dictionary for JSON serialization"""
+        return {
+            'message': dict(self.message),
+            'retry_count': self.retry_count,
+            'max_retries': self.max_retries,
+            'error_reason': self.error_reason,
+            'original_timestamp': self.original_timestamp,
+            'added_to_retry': self.added_to_retry,
+            'next_retry_time': self.next_retry_time,
+            'retry_history': self.retry_history,
+            'retry_id': self.label,
+            'last_attempt': self.last_attempt,
+            'last_delay': self.last_delay
+        }
+
 
 class RetryQueue:
     """
@@ -23,7 +89,11 @@ class RetryQueue:
                  max_delay: float = 60.0,
                  backoff_multiplier: float = 2.0,
                  success_callback: Optional[Callable] = None,
-                 failure_callback: Optional[Callable] = None):
+                 failure_callback: Optional[Callable] = None,
+                 max_workers: int = 16,
+                 jitter: str = 'full',
+                 delivery_handler: Optional[Callable[[Dict], bool]] = None,
+                 max_queue_size: int = 10000):
         """
         Initialize retry queue
         
@@ -34,19 +104,37 @@ class RetryQueue:
             backoff_multiplier: Exponential backoff multiplier
             success_callback: Function called when message is successfully retried
             failure_callback: Function called when message fails permanently
+            max_workers: Number of delivery lanes retries are attempted on in parallel
+            jitter: Backoff jitter strategy, one of JITTER_MODES; spreads out
+                retries of messages that failed together
+            delivery_handler: Function that delivers a message and returns True
+                on success; defaults to the simulated delivery
+            max_queue_size: Most messages held for retry at once; further
+                failures are rejected (and counted as dropped) until there is room
         """
         self.max_retries = max_retries
         self.initial_delay = initial_delay
         self.max_delay = max_delay
         self.backoff_multiplier = backoff_multiplier
+        self.jitter = jitter if jitter in JITTER_MODES else 'full'
         self.success_callback = success_callback
         self.failure_callback = failure_callback
+        self.delivery_handler = delivery_handler or self._simulate_message_delivery
+        self.max_queue_size = max(1, max_queue_size)
+        
+        # Clamped backoff delay for each attempt, indexed by retry_count - 1
+        self._delay_table = self._build_delay_table()
         
         # Deque for pending retries (FIFO for fairness)
         self.retry_deque = deque()
         
-        # Deque for messages currently waiting for retry time
-        self.waiting_deque = deque()
+        # Min-heap of (next_retry_time, seq, entry) for messages waiting for
+        # their retry time; seq breaks ties so entries are never compared
+        self.waiting_heap: List[tuple] = []
+        self._waiting_seq = itertools.count()
+        
+        # Integer retry ids
+        self._retry_ids = itertools.count(1)
         
         # Statistics
         self.stats = {
@@ -54,22 +142,40 @@ class RetryQueue:
             'total_retries_attempted': 0,
             'total_messages_succeeded': 0,
             'total_messages_failed': 0,
+            'total_messages_dropped': 0,
             'average_retry_count': 0.0,
             'total_retry_time': 0.0,
-            'average_retry_time': 0.0,
-            'current_queue_size': 0,
-            'current_waiting_size': 0
+            'average_retry_time': 0.0
         }
         
-        # Thread control
+        # Thread control. _waiting_lock guards the waiting heap, the retry deque
+        # and the configuration; _stats_lock guards stats. They are never held
+        # together, so producers, the processor and the delivery lanes only
+        # contend on the one they need.
         self.running = True
-        self.lock = threading.Lock()
+        self._waiting_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        
+        # Signalled when the heap gains an entry or the queue stops, so the
+        # processor sleeps exactly until the next retry is due
+        self._work_available = threading.Condition(self._waiting_lock)
+        
+        # Retry attempts run on single-thread lanes picked by sender, so one
+        # user's retries stay in order while different users' run in parallel
+        self._delivery_lanes = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"retry-lane-{index}")
+            for index in range(max(1, max_workers))
+        ]
+        
+        # Entries handed to the lanes and not yet attempted (guarded by _stats_lock);
+        # sizes the processor's dispatch batches
+        self._inflight = 0
         
         # Start retry processor thread
         self.processor_thread = threading.Thread(target=self._retry_processor, daemon=True)
         self.processor_thread.start()
         
-        print(f"✅ RetryQueue initialized: max_retries={max_retries}, initial_delay={initial_delay}s")
+        logger.info(f"✅ RetryQueue initialized: max_retries={max_retries}, initial_delay={initial_delay}s")
     
     def add_failed_message(self, 
                           message: Dict, 
@@ -78,170 +184,285 @@ class RetryQueue:
         """
         Add a failed message to the retry queue
         
+        The message is not copied: the entry holds a read-only view of it, so
+        callers must not mutate a message after handing it over, and
+        callbacks that want to change it build a new dict.
+        
         Args:
             message: Original message that failed
             error_reason: Reason for failure
             original_timestamp: Original message timestamp
             
         Returns:
-            bool: True if message was added to retry queue
+            bool: True if message was added to retry queue, False if it failed
+                or the queue is full
         """
         try:
-            with self.lock:
-                retry_entry = {
-                    'message': message.copy(),
-                    'retry_count': 0,
-                    'max_retries': self.max_retries,
-                    'error_reason': error_reason,
-                    'original_timestamp': original_timestamp or time.time(),
-                    'added_to_retry': time.time(),
-                    'next_retry_time': time.time() + self.initial_delay,
-                    'retry_history': [],
-                    'retry_id': f"retry_{int(time.time() * 1000)}_{len(self.retry_deque)}"
-                }
-                
-                # Add to waiting deque (will be moved to retry deque when ready)
-                self.waiting_deque.append(retry_entry)
+            # Build the entry before taking the lock; only the heap push needs it.
+            # Scheduling uses the monotonic clock so wall-clock jumps can't
+            # reorder or stall retries; original_timestamp stays wall-clock.
+            now = time.monotonic()
+            retry_entry = RetryEntry(
+                message=types.MappingProxyType(message),
+                max_retries=self.max_retries,
+                error_reason=error_reason,
+                original_timestamp=original_timestamp or time.time(),
+                added_to_retry=now,
+                next_retry_time=now + self.initial_delay,
+                retry_id=next(self._retry_ids)
+            )
+            
+            # Add to waiting heap (will be moved to retry deque when ready),
+            # unless the queue is full; rescheduled attempts are never refused
+            with self._waiting_lock:
+                queue_full = len(self.waiting_heap) + len(self.retry_deque) >= self.max_queue_size
+                if not queue_full:
+                    self._schedule(retry_entry)
+            
+            if queue_full:
+                with self._stats_lock:
+                    self.stats['total_messages_dropped'] += 1
+                logger.warning("🚫 Retry queue full (%d), dropped message: '%s...' (Reason: %s)",
+                               self.max_queue_size, message.get('text', '')[:30], error_reason)
+                return False
+            
+            with self._stats_lock:
                 self.stats['total_messages_added'] += 1
-                self.stats['current_waiting_size'] = len(self.waiting_deque)
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("🔄 Added failed message to retry queue: '%s...' (Reason: %s)",
+                             message.get('text', '')[:30], error_reason)
+            
+            return True
+            
+        except Exception as e:
+            logger.error(f"❌ Error adding message to retry queue: {e}")
+            return False
+    
+    def _schedule(self, retry_entry: RetryEntry):
+        """
+        Push an entry onto the waiting heap and wake the processor
+        
+        Must be called with self._waiting_lock held.
+        
+        Args:
+            retry_entry: Retry entry with next_retry_time set
+        """
+        heapq.heappush(self.waiting_heap, (retry_entry.next_retry_time, next(self._waiting_seq), retry_entry))
+        self._work_available.notify()
+    
+    def _dispatch_batch_size(self) -> int:
+        """
+        Adaptive dispatch batch size, fed back from the lanes' load
+        
+        With few attempts in flight the lanes are idle, so due entries are
+        flushed in small batches straight away; as more pile up in flight,
+        the batch grows so each pass amortizes its locking and submits.
+        
+        Returns:
+            int: Maximum number of entries to take off the retry queue
+        """
+        with self._stats_lock:
+            inflight = self._inflight
+        return max(MIN_DISPATCH_BATCH, min(inflight // 2, MAX_DISPATCH_BATCH))
+    
+    def _next_ready_batch(self) -> List[RetryEntry]:
+        """
+        Block until retries are due and take a batch of them off the retry queue
+        
+        Entries whose retry time has passed are moved from the waiting heap
+        to the retry deque; otherwise the thread sleeps on the condition until
+        the earliest retry time or until a new entry is scheduled. At most
+        _dispatch_batch_size() entries are taken; any left over are returned
+        by the next call without sleeping.
+        
+        Returns:
+            List[RetryEntry]: Entries to retry, or an empty list once the queue is stopped
+        """
+        batch_size = self._dispatch_batch_size()
+        
+        with self._work_available:
+            while self.running:
+                current_time = time.monotonic()
                 
-                print(f"🔄 Added failed message to retry queue: '{message.get('text', '')[:30]}...' (Reason: {error_reason})")
+                # Move messages from waiting to retry queue if ready
+                waiting_heap = self.waiting_heap
+                while waiting_heap and waiting_heap[0][0] <= current_time:
+                    self.retry_deque.append(heapq.heappop(waiting_heap)[2])
                 
-                return True
+                retry_deque = self.retry_deque
+                if retry_deque:
+                    popleft = retry_deque.popleft
+                    ready_entries = [popleft() for _ in range(min(batch_size, len(retry_deque)))]
+                    return ready_entries
                 
-        except Exception as e:
-            print(f"❌ Error adding message to retry queue: {e}")
-            return False
+                timeout = waiting_heap[0][0] - current_time if waiting_heap else None
+                self._work_available.wait(timeout)
+        
+        return []
+    
+    def _delivery_lane(self, retry_entry: RetryEntry) -> ThreadPoolExecutor:
+        """Pick the delivery lane for an entry, keyed by the message's sender"""
+        sender = retry_entry.message.get('user', '')
+        return self._delivery_lanes[hash(sender) % len(self._delivery_lanes)]
     
     def _retry_processor(self):
         """
         Background thread that processes retry attempts
         """
-        print("🔄 Retry processor thread started")
+        logger.debug("🔄 Retry processor thread started")
         
         while self.running:
             try:
-                current_time = time.time()
-                
-                with self.lock:
-                    # Move messages from waiting to retry queue if ready
-                    ready_messages = []
-                    remaining_waiting = deque()
-                    
-                    while self.waiting_deque:
-                        entry = self.waiting_deque.popleft()
-                        if current_time >= entry['next_retry_time']:
-                            ready_messages.append(entry)
-                        else:
-                            remaining_waiting.append(entry)
-                    
-                    self.waiting_deque = remaining_waiting
-                    
-                    # Add ready messages to retry queue
-                    for entry in ready_messages:
-                        self.retry_deque.append(entry)
-                    
-                    self.stats['current_queue_size'] = len(self.retry_deque)
-                    self.stats['current_waiting_size'] = len(self.waiting_deque)
+                # Group the due entries by lane and hand each lane its whole
+                # batch in one submit; the processor never waits on delivery
+                lane_batches = {}
+                for entry in self._next_ready_batch():
+                    lane_batches.setdefault(self._delivery_lane(entry), []).append(entry)
                 
-                # Process retry queue
-                if self.retry_deque:
-                    with self.lock:
-                        if self.retry_deque:
-                            entry = self.retry_deque.popleft()
-                    
-                    self._attempt_retry(entry)
-                
-                time.sleep(0.1)  # Small delay to prevent excessive CPU usage
+                for lane, entries in lane_batches.items():
+                    with self._stats_lock:
+                        self._inflight += len(entries)
+                    lane.submit(self._attempt_retry_batch, entries)
                 
             except Exception as e:
-                print(f"❌ Retry processor error: {e}")
+                logger.error(f"❌ Retry processor error: {e}")
                 time.sleep(0.5)
     
-    def _attempt_retry(self, retry_entry: Dict):
+    def _attempt_retry_batch(self, retry_entries: List[RetryEntry]):
+        """
+        Attempt a lane's batch of retries in order
+        
+        Args:
+            retry_entries: Due entries for one lane, oldest first
+        """
+        for retry_entry in retry_entries:
+            self._attempt_retry(retry_entry)
+            with self._stats_lock:
+                self._inflight -= 1
+    
+    def _attempt_retry(self, retry_entry: RetryEntry):
         """
         Attempt to retry a failed message
         
+        Runs on a delivery lane, so several attempts may be in flight at once.
+        Delivery and callbacks run without the lock; stats are updated under it.
+        
         Args:
             retry_entry: Retry entry with message and metadata
         """
         try:
-            retry_entry['retry_count'] += 1
-            retry_start_time = time.time()
+            retry_entry.retry_count += 1
+            retry_start_time = time.monotonic()
             
-            # Record retry attempt
+            # Record retry attempt; the timestamp is wall-clock for the exported log
             retry_attempt = {
-                'attempt_number': retry_entry['retry_count'],
-                'timestamp': retry_start_time,
-                'delay_used': retry_start_time - retry_entry.get('last_attempt', retry_entry['added_to_retry'])
+                'attempt_number': retry_entry.retry_count,
+                'timestamp': time.time(),
+                'delay_used': retry_start_time - (retry_entry.last_attempt or retry_entry.added_to_retry)
             }
             
-            retry_entry['retry_history'].append(retry_attempt)
-            retry_entry['last_attempt'] = retry_start_time
+            retry_entry.retry_history.append(retry_attempt)
+            retry_entry.last_attempt = retry_start_time
             
-            self.stats['total_retries_attempted'] += 1
+            with self._stats_lock:
+                self.stats['total_retries_attempted'] += 1
             
-            print(f"🔄 RETRY ATTEMPT {retry_entry['retry_count']}/{retry_entry['max_retries']}: {retry_entry['retry_id']}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("🔄 RETRY ATTEMPT %d/%d: %s",
+                             retry_entry.retry_count, retry_entry.max_retries, retry_entry.label)
             
-            # Simulate retry attempt (replace with actual retry logic)
-            retry_success = self._simulate_message_delivery(retry_entry['message'])
+            retry_success = self.delivery_handler(retry_entry.message)
+            finished_time = time.monotonic()
             
             if retry_success:
                 # Success
-                retry_time = time.time() - retry_entry['added_to_retry']
-                self.stats['total_messages_succeeded'] += 1
-                self.stats['total_retry_time'] += retry_time
-                
-                if self.stats['total_messages_succeeded'] > 0:
+                retry_time = finished_time - retry_entry.added_to_retry
+                with self._stats_lock:
+                    self.stats['total_messages_succeeded'] += 1
+                    self.stats['total_retry_time'] += retry_time
                     self.stats['average_retry_time'] = self.stats['total_retry_time'] / self.stats['total_messages_succeeded']
+                    self._update_average_retry_count()
                 
-                print(f"✅ RETRY SUCCESS: {retry_entry['retry_id']} after {retry_entry['retry_count']} attempts")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("✅ RETRY SUCCESS: %s after %d attempts",
+                                 retry_entry.label, retry_entry.retry_count)
                 
                 if self.success_callback:
                     self.success_callback(retry_entry, retry_time)
                     
             else:
                 # Failed - check if should retry again
-                if retry_entry['retry_count'] >= retry_entry['max_retries']:
+                if retry_entry.retry_count >= retry_entry.max_retries:
                     # Permanent failure
-                    self.stats['total_messages_failed'] += 1
+                    with self._stats_lock:
+                        self.stats['total_messages_failed'] += 1
+                        self._update_average_retry_count()
                     
-                    print(f"❌ PERMANENT FAILURE: {retry_entry['retry_id']} after {retry_entry['retry_count']} attempts")
+                    logger.warning("❌ PERMANENT FAILURE: %s after %d attempts",
+                                   retry_entry.label, retry_entry.retry_count)
                     
                     if self.failure_callback:
                         self.failure_callback(retry_entry, "max_retries_exceeded")
                         
                 else:
                     # Schedule for next retry with exponential backoff
-                    delay = self._calculate_backoff_delay(retry_entry['retry_count'])
-                    retry_entry['next_retry_time'] = time.time() + delay
+                    delay = self._calculate_backoff_delay(retry_entry.retry_count, retry_entry.last_delay)
+                    retry_entry.last_delay = delay
+                    retry_entry.next_retry_time = finished_time + delay
                     
-                    with self.lock:
-                        self.waiting_deque.append(retry_entry)
-                        self.stats['current_waiting_size'] = len(self.waiting_deque)
+                    with self._waiting_lock:
+                        self._schedule(retry_entry)
                     
-                    print(f"⏳ RETRY SCHEDULED: {retry_entry['retry_id']} in {delay:.2f}s (attempt {retry_entry['retry_count'] + 1})")
-            
-            # Update average retry count
-            if self.stats['total_messages_succeeded'] + self.stats['total_messages_failed'] > 0:
-                total_finished = self.stats['total_messages_succeeded'] + self.stats['total_messages_failed']
-                self.stats['average_retry_count'] = self.stats['total_retries_attempted'] / total_finished
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("⏳ RETRY SCHEDULED: %s in %.2fs (attempt %d)",
+                                     retry_entry.label, delay, retry_entry.retry_count + 1)
                 
         except Exception as e:
-            print(f"❌ Retry attempt error: {e}")
+            logger.error(f"❌ Retry attempt error: {e}")
     
-    def _calculate_backoff_delay(self, retry_count: int) -> float:
+    def _update_average_retry_count(self):
+        """Recompute the average attempts per finished message; _stats_lock must be held"""
+        total_finished = self.stats['total_messages_succeeded'] + self.stats['total_messages_failed']
+        if total_finished > 0:
+            self.stats['average_retry_count'] = self.stats['total_retries_attempted'] / total_finished
+    
+    def _calculate_backoff_delay(self, retry_count: int, previous_delay: Optional[float] = None) -> float:
         """
-        Calculate exponential backoff delay
+        Calculate exponential backoff delay, with jitter
+        
+        Looks the base delay up in the precomputed table; counts past the end
+        of the table use its last (largest) delay. Jitter then randomizes it
+        so messages that failed together don't all retry at the same instant.
         
         Args:
             retry_count: Current retry count
+            previous_delay: Delay used before this entry's last attempt
+                (only used by decorrelated jitter)
             
         Returns:
             float: Delay in seconds
         """
-        delay = self.initial_delay * (self.backoff_multiplier ** (retry_count - 1))
-        return min(delay, self.max_delay)
+        delay_table = self._delay_table
+        base_delay = delay_table[min(retry_count, len(delay_table)) - 1]
+        
+        if self.jitter == 'full':
+            return random.uniform(0, base_delay)
+        if self.jitter == 'decorrelated':
+            return min(self.max_delay, random.uniform(self.initial_delay, (previous_delay or self.initial_delay) * 3))
+        return base_delay
+    
+    def _build_delay_table(self) -> tuple:
+        """
+        Precompute the clamped exponential backoff delay for every attempt
+        
+        Returns:
+            tuple: Delay in seconds for retry counts 1..max_retries
+        """
+        return tuple(
+            min(self.initial_delay * (self.backoff_multiplier ** attempt), self.max_delay)
+            for attempt in range(max(1, self.max_retries))
+        )
     
     def _simulate_message_delivery(self, message: Dict) -> bool:
         """
@@ -254,8 +475,6 @@ class RetryQueue:
             bool: True if delivery successful, False otherwise
         """
         # For testing purposes, simulate random success/failure
-        import random
-        
         # Higher chance of success for urgent messages
         if message.get('priority', 3) == 1:
             success_rate = 0.8
@@ -281,8 +500,9 @@ class RetryQueue:
         """
         try:
             # Attempt immediate delivery
-            if self._simulate_message_delivery(message):
-                print(f"✅ Message delivered successfully: '{message.get('text', '')[:30]}...'")
+            if self.delivery_handler(message):
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("✅ Message delivered successfully: '%s...'", message.get('text', '')[:30])
                 return True
             else:
                 # Delivery failed, add to retry queue
@@ -290,7 +510,7 @@ class RetryQueue:
                 return False
                 
         except Exception as e:
-            print(f"❌ Delivery attempt error: {e}")
+            logger.error(f"❌ Delivery attempt error: {e}")
             self.add_failed_message(message, f"delivery_error: {str(e)}")
             return False
     
@@ -301,20 +521,54 @@ class RetryQueue:
         Returns:
             Dict: Current status information
         """
-        with self.lock:
-            return {
-                'retry_queue_size': len(self.retry_deque),
-                'waiting_queue_size': len(self.waiting_deque),
-                'total_pending': len(self.retry_deque) + len(self.waiting_deque),
-                'is_processing': self.running,
-                'configuration': {
-                    'max_retries': self.max_retries,
-                    'initial_delay': self.initial_delay,
-                    'max_delay': self.max_delay,
-                    'backoff_multiplier': self.backoff_multiplier
-                },
-                'statistics': self.stats.copy()
-            }
+        with self._waiting_lock:
+            retry_queue_size = len(self.retry_deque)
+            waiting_queue_size = len(self.waiting_heap)
+            configuration = self._configuration()
+        
+        statistics = self._statistics(retry_queue_size, waiting_queue_size)
+        
+        return {
+            'retry_queue_size': retry_queue_size,
+            'waiting_queue_size': waiting_queue_size,
+            'total_pending': retry_queue_size + waiting_queue_size,
+            'is_processing': self.running,
+            'configuration': configuration,
+            'statistics': statistics
+        }
+    
+    def _statistics(self, retry_queue_size: int, waiting_queue_size: int) -> Dict:
+        """
+        Copy of the counters plus the current queue sizes
+        
+        The sizes aren't kept in stats, since every schedule and dispatch
+        would have to write them; they are filled in from lengths taken at
+        read time instead.
+        
+        Args:
+            retry_queue_size: Entries due and waiting for dispatch
+            waiting_queue_size: Entries waiting for their retry time
+            
+        Returns:
+            Dict: Statistics snapshot
+        """
+        with self._stats_lock:
+            statistics = self.stats.copy()
+        
+        statistics['current_queue_size'] = retry_queue_size
+        statistics['current_waiting_size'] = waiting_queue_size
+        return statistics
+    
+    def _configuration(self) -> Dict:
+        """Current retry configuration; _waiting_lock must be held"""
+        return {
+            'max_retries': self.max_retries,
+            'initial_delay': self.initial_delay,
+            'max_delay': self.max_delay,
+            'backoff_multiplier': self.backoff_multiplier,
+            'jitter': self.jitter,
+            'max_queue_size': self.max_queue_size
+        }
     
     def get_pending_retries(self) -> List[Dict]:
         """
@@ -323,34 +577,35 @@ class RetryQueue:
         Returns:
             List[Dict]: All pending retry entries with metadata
         """
-        with self.lock:
-            pending = []
-            
-            # Add entries from retry queue
-            for entry in self.retry_deque:
-                pending.append({
-                    'retry_id': entry['retry_id'],
-                    'message_text': entry['message'].get('text', '')[:50],
-                    'retry_count': entry['retry_count'],
-                    'status': 'ready_for_retry',
-                    'error_reason': entry['error_reason'],
-                    'time_in_queue': time.time() - entry['added_to_retry']
-                })
-            
-            # Add entries from waiting queue
-            for entry in self.waiting_deque:
-                time_until_retry = max(0, entry['next_retry_time'] - time.time())
-                pending.append({
-                    'retry_id': entry['retry_id'],
-                    'message_text': entry['message'].get('text', '')[:50],
-                    'retry_count': entry['retry_count'],
-                    'status': 'waiting',
-                    'error_reason': entry['error_reason'],
-                    'time_until_retry': time_until_retry,
-                    'time_in_queue': time.time() - entry['added_to_retry']
-                })
-            
-            return pending
+        # Only copy the references under the lock; the dicts are built after it
+        with self._waiting_lock:
+            ready_snapshot = list(self.retry_deque)
+            waiting_snapshot = [item[2] for item in self.waiting_heap]
+        
+        current_time = time.monotonic()
+        
+        # Add entries from retry queue
+        pending = [{
+            'retry_id': entry.label,
+            'message_text': entry.message.get('text', '')[:50],
+            'retry_count': entry.retry_count,
+            'status': 'ready_for_retry',
+            'error_reason': entry.error_reason,
+            'time_in_queue': current_time - entry.added_to_retry
+        } for entry in ready_snapshot]
+        
+        # Add entries from waiting heap
+        pending += [{
+            'retry_id': entry.label,
+            'message_text': entry.message.get('text', '')[:50],
+            'retry_count': entry.retry_count,
+            'status': 'waiting',
+            'error_reason': entry.error_reason,
+            'time_until_retry': max(0, entry.next_retry_time - current_time),
+            'time_in_queue': current_time - entry.added_to_retry
+        } for entry in waiting_snapshot]
+        
+        return pending
     
     def clear_queue(self, clear_waiting: bool = True) -> int:
         """
@@ -362,19 +617,16 @@ class RetryQueue:
         Returns:
             int: Number of messages cleared
         """
-        with self.lock:
+        with self._waiting_lock:
             cleared_count = len(self.retry_deque)
             
             if clear_waiting:
-                cleared_count += len(self.waiting_deque)
-                self.waiting_deque.clear()
+                cleared_count += len(self.waiting_heap)
+                self.waiting_heap.clear()
             
             self.retry_deque.clear()
-            
-            self.stats['current_queue_size'] = len(self.retry_deque)
-            self.stats['current_waiting_size'] = len(self.waiting_deque)
         
-        print(f"🗑️ Cleared {cleared_count} messages from retry queue")
+        logger.info("🗑️ Cleared %d messages from retry queue", cleared_count)
         return cleared_count
     
     def force_retry_all(self) -> int:
@@ -384,26 +636,29 @@ class RetryQueue:
         Returns:
             int: Number of messages moved to retry queue
         """
-        with self.lock:
+        with self._waiting_lock:
             moved_count = 0
+            current_time = time.monotonic()
             
-            while self.waiting_deque:
-                entry = self.waiting_deque.popleft()
-                entry['next_retry_time'] = time.time()  # Set to immediate retry
+            # Pop in retry-time order so the soonest-due messages go first
+            while self.waiting_heap:
+                entry = heapq.heappop(self.waiting_heap)[2]
+                entry.next_retry_time = current_time  # Set to immediate retry
                 self.retry_deque.append(entry)
                 moved_count += 1
             
-            self.stats['current_queue_size'] = len(self.retry_deque)
-            self.stats['current_waiting_size'] = len(self.waiting_deque)
+            self._work_available.notify()
         
-        print(f"🚀 Forced retry for {moved_count} messages")
+        logger.info("🚀 Forced retry for %d messages", moved_count)
         return moved_count
     
     def update_config(self,
                      max_retries: Optional[int] = None,
                      initial_delay: Optional[float] = None,
                      max_delay: Optional[float] = None,
-                     backoff_multiplier: Optional[float] = None):
+                     backoff_multiplier: Optional[float] = None,
+                     jitter: Optional[str] = None,
+                     max_queue_size: Optional[int] = None):
         """
         Update retry queue configuration
         
@@ -412,8 +667,10 @@ class RetryQueue:
             initial_delay: New initial delay
             max_delay: New maximum delay
             backoff_multiplier: New backoff multiplier
+            jitter: New backoff jitter strategy (ignored unless in JITTER_MODES)
+            max_queue_size: New cap on messages held for retry
         """
-        with self.lock:
+        with self._waiting_lock:
             if max_retries is not None:
                 self.max_retries = max(1, max_retries)
             if initial_delay is not None:
@@ -422,18 +679,30 @@ class RetryQueue:
                 self.max_delay = max(self.initial_delay, max_delay)
             if backoff_multiplier is not None:
                 self.backoff_multiplier = max(1.0, backoff_multiplier)
+            if jitter in JITTER_MODES:
+                self.jitter = jitter
+            if max_queue_size is not None:
+                self.max_queue_size = max(1, max_queue_size)
+            
+            self._delay_table = self._build_delay_table()
         
-        print(f"⚙️ Retry config updated: max_retries={self.max_retries}, initial_delay={self.initial_delay}s")
+        logger.info(f"⚙️ Retry config updated: max_retries={self.max_retries}, initial_delay={self.initial_delay}s")
     
     def stop(self):
         """Stop the retry processor"""
-        self.running = False
+        with self._work_available:
+            self.running = False
+            self._work_available.notify_all()
         
         # Wait for thread to finish
         if self.processor_thread.is_alive():
             self.processor_thread.join(timeout=2.0)
         
-        print(f"⏹️ Retry queue stopped. Final stats: {self.stats}")
+        # Let attempts already in flight finish, but don't block shutdown on them
+        for lane in self._delivery_lanes:
+            lane.shutdown(wait=False)
+        
+        logger.info(f"⏹️ Retry queue stopped. Final stats: {self.stats}")
     
     def export_retry_log(self) -> Dict:
         """
@@ -442,27 +711,28 @@ class RetryQueue:
         Returns:
             Dict: Comprehensive retry processing data
         """
-        with self.lock:
-            return {
-                'timestamp': datetime.now().isoformat(),
-                'configuration': {
-                    'max_retries': self.max_retries,
-                    'initial_delay': self.initial_delay,
-                    'max_delay': self.max_delay,
-                    'backoff_multiplier': self.backoff_multiplier
-                },
-                'current_state': {
-                    'retry_queue_size': len(self.retry_deque),
-                    'waiting_queue_size': len(self.waiting_deque),
-                    'is_running': self.running
-                },
-                'statistics': self.stats.copy(),
-                'pending_retries': self.get_pending_retries()
+        with self._waiting_lock:
+            configuration = self._configuration()
+            current_state = {
+                'retry_queue_size': len(self.retry_deque),
+                'waiting_queue_size': len(self.waiting_heap),
+                'is_running': self.running
             }
+        
+        statistics = self._statistics(current_state['retry_queue_size'], current_state['waiting_queue_size'])
+        
+        # get_pending_retries takes _waiting_lock itself, so it must run outside it
+        return {
+            'timestamp': datetime.now().isoformat(),
+            'configuration': configuration,
+            'current_state': current_state,
+            'statistics': statistics,
+            'pending_retries': self.get_pending_retries()
+        }
 
 
 # Example callback functions
-def retry_success_callback(retry_entry: Dict, total_retry_time: float):
+def retry_success_callback(retry_entry: RetryEntry, total_retry_time: float):
     """
     Example callback for successful retry
     
@@ -470,12 +740,12 @@ def retry_success_callback(retry_entry: Dict, total_retry_time: float):
         retry_entry: The retry entry that succeeded
         total_retry_time: Total time spent retrying
     """
-    print(f"🎉 RETRY SUCCESS CALLBACK: {retry_entry['retry_id']}")
-    print(f"   📊 Attempts: {retry_entry['retry_count']}")
+    print(f"🎉 RETRY SUCCESS CALLBACK: {retry_entry.label}")
+    print(f"   📊 Attempts: {retry_entry.retry_count}")
     print(f"   ⏱️ Total time: {total_retry_time:.2f}s")
 
 
-def retry_failure_callback(retry_entry: Dict, failure_reason: str):
+def retry_failure_callback(retry_entry: RetryEntry, failure_reason: str):
     """
     Example callback for permanent retry failure
     
@@ -483,14 +753,16 @@ def retry_failure_callback(retry_entry: Dict, failure_reason: str):
         retry_entry: The retry entry that failed permanently
         failure_reason: Reason for permanent failure
     """
-    print(f"💔 RETRY FAILURE CALLBACK: {retry_entry['retry_id']}")
-    print(f"   📊 Final attempt count: {retry_entry['retry_count']}")
+    print(f"💔 RETRY FAILURE CALLBACK: {retry_entry.label}")
+    print(f"   📊 Final attempt count: {retry_entry.retry_count}")
     print(f"   ❌ Failure reason: {failure_reason}")
-    print(f"   📝 Original message: '{retry_entry['message'].get('text', '')[:50]}...'")
+    print(f"   📝 Original message: '{retry_entry.message.get('text', '')[:50]}...'")
 
 
 # Example usage and testing
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    
     # Create retry queue with callbacks
     retry_queue = RetryQueue(
         max_retries=3,
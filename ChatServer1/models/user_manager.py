@@ -6,21 +6,61 @@ UPDATED: Added offline queue integration hooks
 
 import time
 import hashlib
+import hmac
+import logging
 import secrets
-from typing import Dict, List, Optional, Set
-from collections import defaultdict
+import threading
+from typing import Callable, Dict, List, Optional, Set
+from collections import OrderedDict, defaultdict
+from operator import itemgetter
+
+try:
+    import bcrypt
+except ImportError:  # bcrypt is optional; fall back to the standard library's PBKDF2
+    bcrypt = None
+
+logger = logging.getLogger("chat.user_manager")
+
+# Stored hashes are "<scheme>$<encoded hash>", so the scheme or its cost can
+# change later and old hashes are still verified (and upgraded on login)
+PASSWORD_SCHEME = 'bcrypt' if bcrypt is not None else 'pbkdf2_sha256'
+
+# bcrypt work factor (2**12 rounds, roughly 250 ms per hash)
+BCRYPT_ROUNDS = 12
+
+# PBKDF2-HMAC-SHA256 iterations when bcrypt is unavailable
+PBKDF2_ITERATIONS = 600000
+
+# bcrypt only uses the first 72 bytes of a password
+MAX_PASSWORD_BYTES = 72
+
+# Failed logins per username within the window before further attempts are refused
+MAX_FAILED_LOGINS = 5
+FAILED_LOGIN_WINDOW = 900  # seconds since the last failure
+
+# Most usernames with failed logins tracked at once (least recently failed are evicted)
+MAX_TRACKED_LOGIN_FAILURES = 10000
+
+# Striped per-user locks guarding user updates
+LOCK_SHARDS = 64
 
 
 class User:
     """
     Represents a chat user with offline queue support
+    
+    Uses __slots__ so each user carries no per-instance dict.
     """
+    __slots__ = ('username', 'password_hash', 'session_id', 'created_at',
+                 'last_active', 'is_online', 'socket_id', 'message_count',
+                 'join_time', 'last_offline_time', 'offline_message_count',
+                 'total_offline_messages_received')
+    
     def __init__(self, username: str, password_hash: str, session_id: str):
         self.username = username
         self.password_hash = password_hash
         self.session_id = session_id
-        self.created_at = time.time()
-        self.last_active = time.time()
+        self.created_at = self.last_active = time.time()
         self.is_online = False
         self.socket_id = None
         self.message_count = 0
@@ -50,16 +90,45 @@ class UserManager:
     UPDATED: Added offline queue integration methods
     """
     
-    def __init__(self):
+    def __init__(self, hash_runner: Optional[Callable] = None):
+        """
+        Initialize user manager
+        
+        Args:
+            hash_runner: Function called as hash_runner(func, *args) to run
+                the slow password hash functions, e.g. eventlet.tpool.execute
+                to keep them off the event loop; defaults to calling inline
+        """
+        self._run_hash = hash_runner or (lambda func, *args: func(*args))
+        
         self.users: Dict[str, User] = {}  # username -> User object
+        self._usernames_lower: Set[str] = set()  # Lowercased usernames, for case-insensitive lookups
         self.sessions: Dict[str, str] = {}  # session_id -> username
-        self.online_users: Set[str] = set()  # Set of online usernames
-        self.socket_to_user: Dict[str, str] = {}  # socket_id -> username
-        self.failed_login_attempts = defaultdict(int)  # Track failed logins
+        self.user_to_sessions: Dict[str, Set[str]] = defaultdict(set)  # username -> session_ids
+        self.offline_usernames: Set[str] = set()  # Set of registered but offline usernames
+        # socket_id -> User; the only record of who is online (see online_users)
+        self.socket_to_user: Dict[str, User] = {}
+        # username -> (failure count, last failure time), least recent first
+        self.failed_login_attempts: OrderedDict = OrderedDict()
         
         # NEW: Offline queue reference (will be set by main app)
         self.offline_queue = None
         
+        # Striped locks guarding each user's multi-step updates (registration,
+        # sessions, online state, failed logins). Single dict operations are
+        # already atomic, so readers take list() snapshots instead of locking;
+        # users in different shards never contend.
+        self._shards = [threading.Lock() for _ in range(LOCK_SHARDS)]
+    
+    def _user_lock(self, username: str) -> threading.Lock:
+        """Get the shard lock guarding a user (case-insensitive, like usernames)"""
+        return self._shards[hash(username.lower()) & (LOCK_SHARDS - 1)]
+    
+    @property
+    def online_users(self) -> Set[str]:
+        """Usernames of online users, derived from the socket map on each access"""
+        return {user.username for user in list(self.socket_to_user.values())}
+    
     def set_offline_queue(self, offline_queue):
         """
         Set reference to offline queue for integration
@@ -68,21 +137,155 @@ class UserManager:
             offline_queue: OfflineQueue instance
         """
         self.offline_queue = offline_queue
-        print("🔗 UserManager linked with OfflineQueue")
+        logger.info("🔗 UserManager linked with OfflineQueue")
+    
+    def _offline_message_counts(self, usernames=None) -> Dict[str, int]:
+        """
+        Pending offline message counts for many users in one offline queue call
+        
+        Args:
+            usernames: Users to count for; every user with messages if None
+            
+        Returns:
+            Dict of username -> pending count (missing users have none)
+        """
+        if not self.offline_queue:
+            return {}
+        return self.offline_queue.get_offline_message_counts(usernames)
+    
+    def offline_snapshot(self) -> Dict:
+        """
+        Read the offline queue once for several stats calls in the same request
+        
+        Pass the result as the snapshot argument of get_user_stats,
+        get_user_activity_report and get_all_users_summary so they share
+        one queue status and one batch of message counts. A caller that
+        already has the queue status can pass {'queue_status': status};
+        methods that need counts then read them themselves.
+        
+        Returns:
+            Dict with 'queue_status' (None without an offline queue) and
+            'counts' (username -> pending offline messages)
+        """
+        return {
+            'queue_status': self.offline_queue.get_queue_status() if self.offline_queue else None,
+            'counts': self._offline_message_counts()
+        }
+    
+    def _offline_queue_status(self, snapshot: Optional[Dict]) -> Optional[Dict]:
+        """Offline queue status from the snapshot, or read now if there is none"""
+        if snapshot is not None:
+            return snapshot['queue_status']
+        return self.offline_queue.get_queue_status() if self.offline_queue else None
+    
+    def _snapshot_counts(self, snapshot: Optional[Dict]) -> Dict[str, int]:
+        """Offline message counts from the snapshot, or read now if it has none"""
+        counts = snapshot.get('counts') if snapshot is not None else None
+        return counts if counts is not None else self._offline_message_counts()
         
     def hash_password(self, password: str) -> str:
         """
-        Hash a password securely
+        Hash a password securely with a random per-user salt
+        
+        Uses bcrypt when it is installed, otherwise PBKDF2-HMAC-SHA256.
         
         Args:
             password: Plain text password
             
         Returns:
-            Hashed password string
+            Hashed password string, tagged with its scheme
+        """
+        password_bytes = password.encode('utf-8')
+        
+        if PASSWORD_SCHEME == 'bcrypt':
+            hashed = self._run_hash(bcrypt.hashpw, password_bytes, bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+            return f"bcrypt${hashed.decode('ascii')}"
+        
+        salt = secrets.token_bytes(16)
+        derived = self._run_hash(hashlib.pbkdf2_hmac, 'sha256', password_bytes, salt, PBKDF2_ITERATIONS)
+        return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${salt.hex()}${derived.hex()}"
+    
+    def verify_password(self, password: str, password_hash: str) -> bool:
+        """
+        Check a password against a stored hash in constant time
+        
+        Args:
+            password: Plain text password
+            password_hash: Hash produced by hash_password
+            
+        Returns:
+            True if the password matches
+        """
+        password_bytes = password.encode('utf-8')
+        scheme, _, encoded = password_hash.partition('$')
+        
+        if scheme == 'bcrypt' and bcrypt is not None:
+            if len(password_bytes) > MAX_PASSWORD_BYTES:
+                return False
+            return self._run_hash(bcrypt.checkpw, password_bytes, encoded.encode('ascii'))
+        
+        if scheme == 'pbkdf2_sha256':
+            iterations, salt, expected = encoded.split('$')
+            derived = self._run_hash(hashlib.pbkdf2_hmac, 'sha256', password_bytes, bytes.fromhex(salt), int(iterations))
+            return hmac.compare_digest(derived.hex(), expected)
+        
+        return False
+    
+    def password_needs_rehash(self, password_hash: str) -> bool:
+        """
+        Check if a stored hash uses an older scheme or cost than the current one
+        
+        Args:
+            password_hash: Hash produced by hash_password
+            
+        Returns:
+            True if the hash should be replaced on the user's next login
+        """
+        scheme, _, encoded = password_hash.partition('$')
+        if scheme != PASSWORD_SCHEME:
+            return True
+        if scheme == 'bcrypt':
+            # Encoded as $2b$<rounds>$<salt+hash>
+            return int(encoded.split('$')[2]) != BCRYPT_ROUNDS
+        return int(encoded.split('$')[0]) != PBKDF2_ITERATIONS
+    
+    def _failed_login_count(self, username: str, current_time: float) -> int:
+        """
+        Get a username's recent failed logins, forgetting them once the window passes
+        
+        Args:
+            username: Username to check
+            current_time: Current time
+            
+        Returns:
+            Number of failed logins within FAILED_LOGIN_WINDOW
+        """
+        entry = self.failed_login_attempts.get(username)
+        if entry is None:
+            return 0
+        
+        count, last_failure = entry
+        if current_time - last_failure > FAILED_LOGIN_WINDOW:
+            self.failed_login_attempts.pop(username, None)
+            return 0
+        return count
+    
+    def _record_failed_login(self, username: str, current_time: float):
+        """
+        Count a failed login, keeping at most MAX_TRACKED_LOGIN_FAILURES usernames
+        
+        Must be called with the user's shard lock held.
+        
+        Args:
+            username: Username that failed to log in
+            current_time: Current time
         """
-        # Add salt for security
-        salt = "chat_system_salt_2025"
-        return hashlib.sha256((password + salt).encode()).hexdigest()
+        attempts = self.failed_login_attempts
+        attempts[username] = (self._failed_login_count(username, current_time) + 1, current_time)
+        attempts.move_to_end(username)
+        
+        if len(attempts) > MAX_TRACKED_LOGIN_FAILURES:
+            attempts.popitem(last=False)
     
     def generate_session_id(self) -> str:
         """
@@ -117,23 +320,34 @@ class UserManager:
             return {'success': False, 'error': 'Username must be less than 20 characters'}
         
         # Check if username already exists (case insensitive)
-        if username.lower() in [u.lower() for u in self.users.keys()]:
+        if username.lower() in self._usernames_lower:
             return {'success': False, 'error': 'Username already taken'}
         
         # Validate password
         if len(password) < 4:
             return {'success': False, 'error': 'Password must be at least 4 characters'}
         
-        # Create new user
+        if len(password.encode('utf-8')) > MAX_PASSWORD_BYTES:
+            return {'success': False, 'error': f'Password must be at most {MAX_PASSWORD_BYTES} bytes'}
+        
+        # Create new user; the slow hash runs before taking the lock, so the
+        # name is checked again under it in case it was taken meanwhile
         session_id = self.generate_session_id()
         password_hash = self.hash_password(password)
         
         user = User(username, password_hash, session_id)
         
-        self.users[username] = user
-        self.sessions[session_id] = username
+        with self._user_lock(username):
+            if username.lower() in self._usernames_lower:
+                return {'success': False, 'error': 'Username already taken'}
+            
+            self.users[username] = user
+            self._usernames_lower.add(username.lower())
+            self.sessions[session_id] = username
+            self.user_to_sessions[username].add(session_id)
+            self.offline_usernames.add(username)
         
-        print(f"👤 New user registered: {username}")
+        logger.info("👤 New user registered: %s", username)
         
         return {
             'success': True,
@@ -153,28 +367,41 @@ class UserManager:
         Returns:
             Dict with login result
         """
-        # Check if user exists
-        if username not in self.users:
-            self.failed_login_attempts[username] += 1
-            return {'success': False, 'error': 'Invalid username or password'}
+        current_time = time.time()
         
-        user = self.users[username]
-        password_hash = self.hash_password(password)
+        # Refuse before hashing once a username has failed too often, so
+        # guessing can't keep the (deliberately slow) password hash busy
+        if self._failed_login_count(username, current_time) >= MAX_FAILED_LOGINS:
+            return {'success': False, 'error': 'Too many failed login attempts, try again later'}
+        
+        user_lock = self._user_lock(username)
+        user = self.users.get(username)
         
-        # Verify password
-        if user.password_hash != password_hash:
-            self.failed_login_attempts[username] += 1
+        # Check if user exists, then verify password (without the lock held)
+        if user is None or not self.verify_password(password, user.password_hash):
+            with user_lock:
+                self._record_failed_login(username, current_time)
             return {'success': False, 'error': 'Invalid username or password'}
         
+        # Upgrade hashes made with an older scheme or cost now that we have the password
+        new_password_hash = None
+        if self.password_needs_rehash(user.password_hash):
+            new_password_hash = self.hash_password(password)
+        
         # Generate new session
         session_id = self.generate_session_id()
-        user.session_id = session_id
-        self.sessions[session_id] = username
         
-        # Reset failed attempts
-        self.failed_login_attempts[username] = 0
+        with user_lock:
+            if new_password_hash is not None:
+                user.password_hash = new_password_hash
+            user.session_id = session_id
+            self.sessions[session_id] = username
+            self.user_to_sessions[username].add(session_id)
+            
+            # Reset failed attempts
+            self.failed_login_attempts.pop(username, None)
         
-        print(f"🔑 User logged in: {username}")
+        logger.info("🔑 User logged in: %s", username)
         
         return {
             'success': True,
@@ -207,29 +434,35 @@ class UserManager:
         Returns:
             True if successful, False if user not found
         """
-        if username not in self.users:
+        user = self.users.get(username)
+        if user is None:
             return False
         
-        user = self.users[username]
-        user.is_online = True
-        user.socket_id = socket_id
-        user.join_time = time.time()
-        user.last_active = time.time()
-        
-        self.online_users.add(username)
-        self.socket_to_user[socket_id] = username
+        with self._user_lock(username):
+            # A reconnect replaces the user's previous socket
+            if user.socket_id is not None:
+                self.socket_to_user.pop(user.socket_id, None)
+            
+            user.is_online = True
+            user.socket_id = socket_id
+            user.join_time = user.last_active = time.time()
+            
+            self.offline_usernames.discard(username)
+            self.socket_to_user[socket_id] = user
         
-        print(f"🟢 {username} is now online")
+        logger.info("🟢 %s is now online", username)
         
         # NEW: Handle offline messages when user comes online
         if self.offline_queue:
             try:
-                delivery_summary = self.offline_queue.handle_user_online(username, self)
+                delivery_summary = self.offline_queue.handle_user_online(username, self.is_user_online)
                 if delivery_summary and delivery_summary['messages_delivered'] > 0:
                     user.total_offline_messages_received += delivery_summary['messages_delivered']
-                    print(f"📬 Delivered {delivery_summary['messages_delivered']} offline messages to {username}")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("📬 Delivered %d offline messages to %s",
+                                     delivery_summary['messages_delivered'], username)
             except Exception as e:
-                print(f"❌ Error handling offline messages for {username}: {e}")
+                logger.error("❌ Error handling offline messages for %s: %s", username, e)
         
         return True
     
@@ -244,26 +477,31 @@ class UserManager:
         Returns:
             Username that went offline, or None
         """
-        username = self.socket_to_user.get(socket_id)
-        if not username:
+        user = self.socket_to_user.get(socket_id)
+        if user is None:
             return None
         
-        user = self.users[username]
-        user.is_online = False
-        user.socket_id = None
-        user.last_offline_time = time.time()  # NEW: Track when user went offline
-        
-        self.online_users.discard(username)
-        del self.socket_to_user[socket_id]
+        username = user.username
+        with self._user_lock(username):
+            # The user may have reconnected on another socket meanwhile
+            if user.socket_id != socket_id:
+                return None
+            
+            self.socket_to_user.pop(socket_id, None)
+            user.is_online = False
+            user.socket_id = None
+            user.last_offline_time = time.time()  # NEW: Track when user went offline
+            
+            self.offline_usernames.add(username)
         
-        print(f"🔴 {username} went offline")
+        logger.info("🔴 %s went offline", username)
         
         # NEW: Notify offline queue that user went offline
         if self.offline_queue:
             try:
                 self.offline_queue.handle_user_offline(username)
             except Exception as e:
-                print(f"❌ Error handling user offline for {username}: {e}")
+                logger.error("❌ Error handling user offline for %s: %s", username, e)
         
         return username
     
@@ -277,7 +515,8 @@ class UserManager:
         Returns:
             Username or None
         """
-        return self.socket_to_user.get(socket_id)
+        user = self.socket_to_user.get(socket_id)
+        return user.username if user is not None else None
     
     def update_user_activity(self, username: str):
         """
@@ -297,26 +536,22 @@ class UserManager:
         Returns:
             List of online user info dicts
         """
-        online_list = []
-        for username in self.online_users:
-            user = self.users[username]
-            
-            # NEW: Include offline message count
-            offline_msg_count = 0
-            if self.offline_queue:
-                offline_msg_count = self.offline_queue.get_offline_message_count(username)
-            
-            online_list.append({
-                'username': username,
-                'join_time': user.join_time,
-                'message_count': user.message_count,
-                'last_active': user.last_active,
-                'offline_messages_waiting': offline_msg_count,  # NEW
-                'total_offline_received': user.total_offline_messages_received  # NEW
-            })
+        online = list(self.socket_to_user.values())
+        offline_counts = self._offline_message_counts([user.username for user in online])
         
-        # Sort by join time (earliest first)
-        online_list.sort(key=lambda x: x['join_time'] or 0)
+        # Rows are dict literals in a comprehension: cheaper per user than
+        # append calls or dict(zip(keys, values))
+        online_list = [{
+            'username': user.username,
+            'join_time': user.join_time,
+            'message_count': user.message_count,
+            'last_active': user.last_active,
+            'offline_messages_waiting': offline_counts.get(user.username, 0),  # NEW
+            'total_offline_received': user.total_offline_messages_received  # NEW
+        } for user in online]
+        
+        # Sort by join time (earliest first); set_user_online always sets it
+        online_list.sort(key=itemgetter('join_time'))
         return online_list
     
     def get_offline_users(self) -> List[Dict]:
@@ -326,51 +561,48 @@ class UserManager:
         Returns:
             List of offline user info dicts
         """
-        offline_list = []
+        offline_counts = self._offline_message_counts()
+        current_time = time.time()
         
-        for username, user in self.users.items():
-            if not user.is_online:
-                # Get offline message count
-                offline_msg_count = 0
-                if self.offline_queue:
-                    offline_msg_count = self.offline_queue.get_offline_message_count(username)
-                
-                offline_list.append({
-                    'username': username,
-                    'last_active': user.last_active,
-                    'last_offline_time': user.last_offline_time,
-                    'offline_duration': time.time() - (user.last_offline_time or user.last_active),
-                    'offline_messages_waiting': offline_msg_count,
-                    'total_messages_sent': user.message_count,
-                    'total_offline_received': user.total_offline_messages_received
-                })
+        offline_list = [{
+            'username': username,
+            'last_active': user.last_active,
+            'last_offline_time': user.last_offline_time,
+            'offline_duration': current_time - (user.last_offline_time or user.last_active),
+            'offline_messages_waiting': offline_counts.get(username, 0),
+            'total_messages_sent': user.message_count,
+            'total_offline_received': user.total_offline_messages_received
+        } for username, user in list(self.users.items()) if not user.is_online]
         
         # Sort by offline duration (longest offline first)
-        offline_list.sort(key=lambda x: x['offline_duration'], reverse=True)
+        offline_list.sort(key=itemgetter('offline_duration'), reverse=True)
         return offline_list
     
-    def get_user_stats(self) -> Dict:
+    def get_user_stats(self, snapshot: Optional[Dict] = None) -> Dict:
         """
         Get overall user statistics with offline queue integration
         UPDATED: Now includes offline-related statistics
         
+        Args:
+            snapshot: Optional result of offline_snapshot() to reuse
+        
         Returns:
             Dict with user statistics
         """
         offline_users_with_messages = 0
         total_offline_messages = 0
         
-        if self.offline_queue:
-            offline_status = self.offline_queue.get_queue_status()
+        offline_status = self._offline_queue_status(snapshot)
+        if offline_status:
             offline_users_with_messages = offline_status['users_with_messages']
             total_offline_messages = offline_status['total_pending_messages']
         
         return {
             'total_registered': len(self.users),
-            'currently_online': len(self.online_users),
-            'currently_offline': len(self.users) - len(self.online_users),
-            'total_failed_logins': sum(self.failed_login_attempts.values()),
-            'online_users': list(self.online_users),
+            'currently_online': len(self.socket_to_user),
+            'currently_offline': len(self.users) - len(self.socket_to_user),
+            'total_failed_logins': sum(count for count, _ in list(self.failed_login_attempts.values())),
+            'online_users': [user.username for user in list(self.socket_to_user.values())],
             'offline_users_with_messages': offline_users_with_messages,  # NEW
             'total_offline_messages_pending': total_offline_messages,  # NEW
             'offline_queue_active': self.offline_queue is not None  # NEW
@@ -422,7 +654,20 @@ class UserManager:
         Returns:
             True if available, False if taken
         """
-        return username.lower() not in [u.lower() for u in self.users.keys()]
+        return username.lower() not in self._usernames_lower
+    
+    def is_user_online(self, username: str) -> bool:
+        """
+        Check if a user is currently online
+        
+        Args:
+            username: Username to check
+            
+        Returns:
+            True if the user is online
+        """
+        user = self.users.get(username)
+        return user is not None and user.is_online
     
     def logout_user(self, session_id: str) -> bool:
         """
@@ -440,14 +685,17 @@ class UserManager:
             return False
         
         # Remove session
-        del self.sessions[session_id]
+        with self._user_lock(username):
+            if self.sessions.pop(session_id, None) is None:
+                return False
+            self.user_to_sessions[username].discard(session_id)
+            socket_id = self.users[username].socket_id
         
         # Set user offline if they were online
-        user = self.users[username]
-        if user.socket_id:
-            self.set_user_offline(user.socket_id)
+        if socket_id:
+            self.set_user_offline(socket_id)
         
-        print(f"👋 {username} logged out")
+        logger.info("👋 %s logged out", username)
         return True
     
     def get_users_for_broadcast(self, exclude_user: Optional[str] = None) -> Dict:
@@ -462,8 +710,9 @@ class UserManager:
         """
         online_users = []
         offline_users = []
+        current_time = time.time()
         
-        for username, user in self.users.items():
+        for username, user in list(self.users.items()):
             if exclude_user and username == exclude_user:
                 continue
                 
@@ -474,10 +723,11 @@ class UserManager:
                     'last_active': user.last_active
                 })
             else:
+                last_offline = user.last_offline_time or user.last_active
                 offline_users.append({
                     'username': username,
-                    'last_offline': user.last_offline_time or user.last_active,
-                    'offline_duration': time.time() - (user.last_offline_time or user.last_active)
+                    'last_offline': last_offline,
+                    'offline_duration': current_time - last_offline
                 })
         
         return {
@@ -500,22 +750,31 @@ class UserManager:
         current_time = time.time()
         max_inactive_seconds = max_inactive_hours * 3600
         
-        inactive_sessions = []
+        cleaned_count = 0
         
-        for session_id, username in self.sessions.items():
-            user = self.users.get(username)
-            if user:
-                inactive_time = current_time - user.last_active
-                if inactive_time > max_inactive_seconds and not user.is_online:
-                    inactive_sessions.append(session_id)
-        
-        # Remove inactive sessions
-        for session_id in inactive_sessions:
-            username = self.sessions[session_id]
-            del self.sessions[session_id]
-            print(f"🧹 Cleaned up inactive session for {username}")
+        # Inactivity is per user, so check each user once and drop all of
+        # their sessions through the reverse index. Iterate a snapshot so a
+        # green thread switch mid-loop can't let a registration resize users.
+        for username, user in list(self.users.items()):
+            if user.is_online or current_time - user.last_active <= max_inactive_seconds:
+                continue
+            
+            with self._user_lock(username):
+                # Re-check under the lock in case the user just came back
+                if user.is_online:
+                    continue
+                
+                session_ids = self.user_to_sessions.pop(username, None)
+                if not session_ids:
+                    continue
+                
+                for session_id in session_ids:
+                    self.sessions.pop(session_id, None)
+            
+            cleaned_count += len(session_ids)
+            logger.info("🧹 Cleaned up %d inactive sessions for %s", len(session_ids), username)
         
-        return len(inactive_sessions)
+        return cleaned_count
     
     def force_user_offline(self, username: str) -> bool:
         """
@@ -535,15 +794,18 @@ class UserManager:
         
         if socket_id:
             self.set_user_offline(socket_id)
-            print(f"👮 Forced {username} offline")
+            logger.info("👮 Forced %s offline", username)
             return True
         
         return False
     
-    def get_user_activity_report(self) -> Dict:
+    def get_user_activity_report(self, snapshot: Optional[Dict] = None) -> Dict:
         """
         NEW: Get detailed user activity report
         
+        Args:
+            snapshot: Optional result of offline_snapshot() to reuse
+        
         Returns:
             Dict with comprehensive user activity data
         """
@@ -553,8 +815,8 @@ class UserManager:
             'report_timestamp': current_time,
             'summary': {
                 'total_users': len(self.users),
-                'online_users': len(self.online_users),
-                'offline_users': len(self.users) - len(self.online_users),
+                'online_users': len(self.socket_to_user),
+                'offline_users': len(self.users) - len(self.socket_to_user),
                 'users_with_offline_messages': 0,
                 'total_offline_messages': 0
             },
@@ -562,16 +824,16 @@ class UserManager:
         }
         
         # Get offline queue stats if available
-        if self.offline_queue:
-            offline_status = self.offline_queue.get_queue_status()
+        offline_status = self._offline_queue_status(snapshot)
+        if offline_status:
             activity_report['summary']['users_with_offline_messages'] = offline_status['users_with_messages']
             activity_report['summary']['total_offline_messages'] = offline_status['total_pending_messages']
         
         # Add individual user details
-        for username, user in self.users.items():
-            offline_msg_count = 0
-            if self.offline_queue:
-                offline_msg_count = self.offline_queue.get_offline_message_count(username)
+        offline_counts = self._snapshot_counts(snapshot)
+        
+        for username, user in list(self.users.items()):
+            offline_msg_count = offline_counts.get(username, 0)
             
             user_detail = {
                 'username': username,
@@ -593,7 +855,7 @@ class UserManager:
             activity_report['user_details'].append(user_detail)
         
         # Sort by last active (most recent first)
-        activity_report['user_details'].sort(key=lambda x: x['last_active'], reverse=True)
+        activity_report['user_details'].sort(key=itemgetter('last_active'), reverse=True)
         
         return activity_report
     
@@ -607,22 +869,25 @@ class UserManager:
         """
         if username in self.users:
             self.users[username].total_offline_messages_received += delivered_count
-            print(f"📊 Updated offline delivery stats for {username}: +{delivered_count} messages")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📊 Updated offline delivery stats for %s: +%d messages", username, delivered_count)
     
-    def get_all_users_summary(self) -> List[Dict]:
+    def get_all_users_summary(self, snapshot: Optional[Dict] = None) -> List[Dict]:
         """
         NEW: Get summary of all users (online and offline)
         
+        Args:
+            snapshot: Optional result of offline_snapshot() to reuse
+        
         Returns:
             List[Dict]: Summary information for all users
         """
         current_time = time.time()
         users_summary = []
+        offline_counts = self._snapshot_counts(snapshot)
         
-        for username, user in self.users.items():
-            offline_msg_count = 0
-            if self.offline_queue:
-                offline_msg_count = self.offline_queue.get_offline_message_count(username)
+        for username, user in list(self.users.items()):
+            offline_msg_count = offline_counts.get(username, 0)
             
             summary = {
                 'username': username,
@@ -0,0 +1,120 @@
+"""
+Offline Queue Tests
+Delivery callback failure handling and expiry heap bounds
+
+Run from ChatServer1 with: python -m unittest discover -s tests -t .
+"""
+
+import time
+import unittest
+
+from models.offline_queue import OfflineQueue
+
+
+class SocketEmitCallback:
+    """
+    Delivery callback shaped like the app's offline_delivery_callback: it
+    catches its own emit errors, logs them and reports failure by returning False
+    """
+
+    def __init__(self):
+        self.fail = True
+        self.received = []
+
+    def emit(self, username, messages):
+        if self.fail:
+            raise ConnectionError("socket closed")
+        self.received.extend(messages)
+
+    def __call__(self, username, messages):
+        try:
+            self.emit(username, messages)
+            return True
+        except Exception:
+            return False
+
+
+class OfflineDeliveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.callback = SocketEmitCallback()
+        self.queue = OfflineQueue(max_messages_per_user=10, delivery_callback=self.callback)
+
+    def tearDown(self):
+        self.queue.stop()
+
+    def test_failed_emit_keeps_messages_queued(self):
+        self.queue.store_message_for_user('alice', {'text': 'first', 'user': 'bob'})
+        self.queue.store_message_for_user('alice', {'text': 'second', 'user': 'bob'})
+
+        delivered = self.queue.deliver_offline_messages('alice', lambda username: True)
+
+        self.assertEqual(delivered, [])
+        self.assertEqual(self.queue.get_offline_message_count('alice'), 2)
+        self.assertEqual(self.queue.stats['total_messages_delivered'], 0)
+
+        # Once the socket works again the same messages arrive, in order
+        self.callback.fail = False
+        delivered = self.queue.deliver_offline_messages('alice', lambda username: True)
+
+        self.assertEqual([msg['text'] for msg in delivered], ['first', 'second'])
+        self.assertEqual([msg['text'] for msg in self.callback.received], ['first', 'second'])
+        self.assertEqual(self.queue.get_offline_message_count('alice'), 0)
+
+    def test_messages_dropped_after_max_delivery_attempts(self):
+        self.queue.store_message_for_user('alice', {'text': 'hello', 'user': 'bob'})
+
+        for _ in range(3):
+            self.queue.deliver_offline_messages('alice', lambda username: True)
+
+        self.assertEqual(self.queue.get_offline_message_count('alice'), 0)
+        self.assertEqual(self.callback.received, [])
+
+
+class ExpiryHeapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = OfflineQueue(max_messages_per_user=10)
+
+    def tearDown(self):
+        self.queue.stop()
+
+    def test_heap_holds_one_entry_per_user(self):
+        for index in range(1000):
+            self.queue.store_message_for_user('alice', {'text': f'message {index}'})
+        for _ in range(100):
+            self.queue.store_message_for_multiple_users(['bob', 'carol'], {'text': 'group'})
+
+        self.assertEqual(len(self.queue._expiry_heap), 3)
+
+        self.queue.clear_user_messages('alice')
+        self.queue.deliver_offline_messages('bob', lambda username: True)
+
+        self.assertLessEqual(len(self.queue._expiry_heap), 3)
+
+    def test_store_during_cleanup_keeps_oldest_expiry(self):
+        self.queue.stop()  # drive cleanup by hand
+        self.queue.store_message_for_user('alice', {'text': 'expired'})
+        self.queue.store_message_for_user('alice', {'text': 'oldest live'})
+        user_queue = self.queue.user_queues['alice']
+        user_queue[0].expiry_timestamp = time.time() - 1
+        self.queue._expiry_heap[:] = [(user_queue[0].expiry_timestamp, 'alice')]
+
+        # Store a message after cleanup pops alice's heap entry, before it trims her queue
+        user_lock = self.queue._user_lock
+        pending_store = ['newest']
+
+        def store_then_lock(username):
+            if pending_store:
+                self.queue.store_message_for_user(username, {'text': pending_store.pop()})
+            return user_lock(username)
+
+        self.queue._user_lock = store_then_lock
+        self.queue._cleanup_expired_messages()
+
+        self.assertEqual([msg.original_message['text'] for msg in user_queue], ['oldest live', 'newest'])
+        self.assertEqual(self.queue._expiry_heap, [(user_queue[0].expiry_timestamp, 'alice')])
+
+
+if __name__ == '__main__':
+    unittest.main()
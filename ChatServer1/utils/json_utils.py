@@ -0,0 +1,46 @@
+"""
+JSON Utility Functions
+Fast JSON encoding for SocketIO packets and log exports
+"""
+
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the standard library
+    orjson = None
+
+
+def dumps(obj: Any, *args, **kwargs) -> str:
+    """
+    Serialize obj to a JSON string
+    
+    Uses orjson when it is installed. Extra arguments (e.g. the separators
+    python-socketio passes) are only honoured by the stdlib fallback, since
+    orjson always emits compact output.
+    
+    Args:
+        obj: Object to serialize
+        
+    Returns:
+        JSON string
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(obj, *args, **kwargs)
+
+
+def loads(data, *args, **kwargs) -> Any:
+    """
+    Deserialize a JSON string or bytes
+    
+    Args:
+        data: JSON document
+        
+    Returns:
+        Decoded Python object
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data, *args, **kwargs)
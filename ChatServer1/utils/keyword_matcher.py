@@ -0,0 +1,107 @@
+"""
+Keyword Matcher
+Whole-word multi-keyword scanning for spam and priority detection
+"""
+
+import re
+from typing import Dict, List
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional; fall back to one regex per category
+    ahocorasick = None
+
+
+def _is_word_char(ch: str) -> bool:
+    """Same notion of a word character as the regex \\w class"""
+    return ch.isalnum() or ch == '_'
+
+
+def _at_word_boundary(text: str, index: int) -> bool:
+    """True if a regex \\b would match at text[index]"""
+    before = index > 0 and _is_word_char(text[index - 1])
+    after = index < len(text) and _is_word_char(text[index])
+    return before != after
+
+
+class KeywordMatcher:
+    """
+    Finds which keyword categories occur in a text, as whole words
+    
+    With pyahocorasick installed every category is matched in a single
+    Aho-Corasick pass over the text; otherwise each category is searched with
+    its own \\b-delimited alternation regex. Both give the same categories.
+    
+    The keyword sets never change after construction, so the backend is
+    chosen once there: search is bound directly to the matching scan and
+    calls never branch on which backend is in use.
+    """
+    
+    def __init__(self, categories: Dict[str, List[str]]):
+        """
+        Build the matcher
+        
+        Args:
+            categories: Mapping of category name to its keywords
+        """
+        if ahocorasick is not None:
+            # A keyword may belong to several categories, so each entry carries all of them
+            keyword_categories = {}
+            for category, keywords in categories.items():
+                for keyword in keywords:
+                    keyword_categories.setdefault(keyword, []).append(category)
+            
+            self.automaton = ahocorasick.Automaton()
+            for keyword, owners in keyword_categories.items():
+                self.automaton.add_word(keyword, (keyword, tuple(owners)))
+            self.automaton.make_automaton()
+            self.patterns = None
+            self._iter_matches = self.automaton.iter
+            self._total = len(categories)
+            self.search = self._search_automaton
+        else:
+            self.automaton = None
+            # Tuple of (category, compiled pattern) so the scan loop skips dict iteration
+            self.patterns = tuple(
+                (category, re.compile(r"\b(?:" + "|".join(re.escape(k) for k in keywords) + r")\b"))
+                for category, keywords in categories.items()
+            )
+            self.search = self._search_patterns
+    
+    def search(self, text: str) -> Dict[str, str]:
+        """
+        Find the first whole-word keyword hit for each category
+        
+        Documentation stub: __init__ binds search on each instance to the
+        scan for the available backend, so this body never runs.
+        
+        Args:
+            text: Text to scan (already lowercased/normalized by the caller)
+        
+        Returns:
+            Dict of category -> matched keyword, only for categories that hit
+        """
+    
+    def _search_automaton(self, text: str) -> Dict[str, str]:
+        """Single Aho-Corasick pass, stopping once every category has hit"""
+        found = {}
+        total = self._total
+        
+        for end_index, (keyword, owners) in self._iter_matches(text):
+            if (_at_word_boundary(text, end_index - len(keyword) + 1)
+                    and _at_word_boundary(text, end_index + 1)):
+                for category in owners:
+                    found.setdefault(category, keyword)
+                if len(found) == total:
+                    break
+        return found
+    
+    def _search_patterns(self, text: str) -> Dict[str, str]:
+        """One alternation regex search per category"""
+        found = {}
+        
+        for category, pattern in self.patterns:
+            match = pattern.search(text)
+            if match:
+                found[category] = match.group(0)
+        return found